@@ -0,0 +1,418 @@
+"""قياس أداء معالجة التحديثات دون اتصال بتيليجرام أو يوتيوب
+
+يرسل تحديثات Update مصطنعة مباشرة إلى handle_message و handle_button و handle_admin_buttons
+باستخدام بوت وهمي يسجل الاستدعاءات ونسخة وهمية من yt-dlp تتحكم في حجم الملفات ومدة التحميل.
+كل عدد مستخدمين يقاس في عملية مستقلة وفي مجلد مؤقت حتى لا تتأثر النتائج ببعضها.
+
+    python benchmark.py
+    python benchmark.py --users 1000 100000 --updates 50000 --json results.json
+    python benchmark.py --baseline results.json   # فشل (رمز خروج 1) عند تراجع الأداء
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import tempfile
+import subprocess
+import threading
+from types import SimpleNamespace
+
+from telegram import Bot, Message
+
+ADMIN_ID = 1
+BENCH_TOKEN = '123456:bench'
+DEFAULT_MIX = 'message=70,link=15,button=10,admin=5'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='أعداد المستخدمين المسجلين مسبقاً')
+    parser.add_argument('--updates', type=int, default=20000, help='عدد التحديثات في كل قياس')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='نسب أنواع التحديثات')
+    parser.add_argument('--videos', type=int, default=200, help='عدد الفيديوهات المختلفة (يحدد نسبة إصابة الذاكرة المؤقتة)')
+    parser.add_argument('--new-users', type=float, default=0.01, help='نسبة التحديثات من مستخدمين جدد')
+    parser.add_argument('--media-size', type=int, default=256 * 1024, help='حجم الملف الذي تكتبه yt-dlp الوهمية بالبايت')
+    parser.add_argument('--download-delay', type=float, default=0.05, help='مدة التحميل الوهمي بالثواني')
+    parser.add_argument('--progress-steps', type=int, default=10, help='عدد استدعاءات دالة التقدم لكل تحميل')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='حفظ النتائج في ملف JSON')
+    parser.add_argument('--baseline', help='مقارنة النتائج بملف JSON سابق')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='أقصى تراجع مسموح عند المقارنة (0.2 = 20%%)')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)  # تشغيل قياس واحد داخل العملية الفرعية
+    return parser.parse_args(argv)
+
+
+def read_proc_io():
+    """عدادات الكتابة للعملية الحالية (لينكس فقط)"""
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(': ') for line in f)}
+    except OSError:
+        return None
+
+
+def read_rss():
+    """الذاكرة المستخدمة فعلياً بالبايت"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class FakeBot(Bot):
+    """بوت وهمي يسجل استدعاءات Bot API ويرجع كائنات Message حقيقية"""
+
+    def __init__(self):
+        super().__init__(BENCH_TOKEN, base_url='http://bench.invalid/bot')
+        self.calls = {}
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def _record(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def _message(self, chat_id, **fields):
+        data = {'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, **fields}
+        return Message.de_json(data, self)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._record('sendMessage')
+        return self._message(chat_id, text=text)
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        self._record('editMessageText')
+        return self._message(chat_id or 0, text=text)
+
+    def send_video(self, chat_id, video, **kwargs):
+        self._record('sendVideo')
+        file_id = video if isinstance(video, str) else f'video-{chat_id}-{time.monotonic_ns()}'
+        return self._message(chat_id, video={'file_id': file_id, 'file_unique_id': file_id,
+                                             'width': 1, 'height': 1, 'duration': 1})
+
+    def send_audio(self, chat_id, audio, **kwargs):
+        self._record('sendAudio')
+        file_id = audio if isinstance(audio, str) else f'audio-{chat_id}-{time.monotonic_ns()}'
+        return self._message(chat_id, audio={'file_id': file_id, 'file_unique_id': file_id, 'duration': 1})
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self._record('answerCallbackQuery')
+        return True
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self._record('deleteMessage')
+        return True
+
+
+class StubYoutubeDL:
+    """نسخة وهمية من yt_dlp.YoutubeDL تكتب ملفاً بالحجم المطلوب وتستدعي دوال التقدم"""
+
+    size = 256 * 1024
+    delay = 0.05
+    steps = 10
+    bytes_written = 0
+    lock = threading.Lock()
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _info(self, url):
+        video_id = url.rsplit('=', 1)[-1].rsplit('/', 1)[-1][:11]
+        return {
+            '_type': 'video', 'id': video_id, 'title': f'Video {video_id}', 'ext': 'mp4',
+            'extractor': 'youtube', 'duration': 60,
+            'formats': [
+                {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a',
+                 'height': 360, 'filesize': self.size},
+                {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a',
+                 'abr': 128, 'filesize': self.size // 8},
+            ],
+        }
+
+    def extract_info(self, url, download=True, process=True):
+        info = self._info(url)
+        return self.process_ie_result(info, download=True) if download else info
+
+    def process_ie_result(self, info, download=True):
+        info = dict(info)
+        if not download:
+            return info
+        hooks = self.opts.get('progress_hooks') or []
+        path = self.prepare_filename(info)
+        for step in range(1, self.steps + 1):
+            time.sleep(self.delay / self.steps)
+            for hook in hooks:
+                hook({'status': 'downloading', 'total_bytes': self.size,
+                      'downloaded_bytes': self.size * step // self.steps,
+                      'speed': self.size / max(self.delay, 0.001), 'eta': 0})
+        if any(pp.get('key') == 'FFmpegExtractAudio' for pp in self.opts.get('postprocessors') or []):
+            path = os.path.splitext(path)[0] + '.mp3'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        chunk = b'\0' * min(self.size, 1024 * 1024)
+        with open(path, 'wb') as f:
+            remaining = self.size
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
+        with StubYoutubeDL.lock:
+            StubYoutubeDL.bytes_written += self.size
+        for hook in hooks:
+            hook({'status': 'finished', 'total_bytes': self.size, 'downloaded_bytes': self.size, 'filename': path})
+        return info
+
+    def prepare_filename(self, info):
+        outtmpl = self.opts.get('outtmpl') or '%(title)s.%(ext)s'
+        if isinstance(outtmpl, dict):
+            outtmpl = outtmpl['default']
+        return outtmpl % info
+
+
+def configure_environment(workdir):
+    """إعدادات البوت قبل استيراده: ملفات مؤقتة وحدود لا تعيق القياس"""
+    os.chdir(workdir)
+    os.environ.update({
+        'TELEGRAM_TOKEN': BENCH_TOKEN,
+        'ADMIN_ID': str(ADMIN_ID),
+        'USER_REQUESTS_BURST': '1000000000',
+        'CHAT_REQUESTS_BURST': '1000000000',
+        'GLOBAL_REQUESTS_BURST': '1000000000',
+        'USER_REQUESTS_PER_MINUTE': '1000000000',
+        'CHAT_REQUESTS_PER_MINUTE': '1000000000',
+        'GLOBAL_REQUESTS_PER_SECOND': '1000000000',
+        'DOWNLOAD_QUEUE_SIZE': '1000000000',
+        'MAX_JOBS_PER_USER': '1000000000',
+        'WORKER_PROCESSES': '0',
+        'METRICS_PORT': '0',
+    })
+
+
+def user_record(bot, uid, now):
+    return bot.UserRecord(
+        uid, f'name{uid}', None, f'user{uid}', 'ar', downloads=uid % 7, youtube_downloads=uid % 5,
+        snapchat_downloads=uid % 3, join_date=now - (uid % 400) * 86400, last_active=now - (uid % 20000) * 60,
+        total_interactions=uid % 50,
+    )
+
+
+def populate(bot, users):
+    """إنشاء قاعدة مستخدمين مصطنعة ثم تحميلها كما يحدث عند تشغيل البوت"""
+    now = int(time.time())
+    bot.state.open()
+    bot.user_store.open()
+    bot.job_journal.open()
+    bot.media_cache.load()
+    data = {
+        'users': {uid: user_record(bot, uid, now) for uid in range(1, users + 1)},
+        'total_downloads': users * 3,
+    }
+    bot.user_store.save_all(data)
+    del data
+    started = time.perf_counter()
+    bot.load_users_data()
+    return time.perf_counter() - started
+
+
+def build_updates(args, users, fake_bot, bot):
+    """تجهيز التحديثات مسبقاً حتى لا يدخل إنشاؤها في القياس"""
+    from telegram import Update
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*((kind, float(weight)) for kind, weight in
+                           (item.split('=') for item in args.mix.split(','))))
+    videos = [f'v{i:010d}' for i in range(args.videos)]
+    tokens = [bot.callback_tokens.issue(bot.parse_media_url(f'https://youtu.be/{video_id}')) for video_id in videos]
+    # الرموز تنتهي بعد CALLBACK_TOKENS_SIZE، لذلك تحجز رموز الأزرار قبل الروابط
+    new_ids = itertools.count(users + 1)
+    update_ids = itertools.count(1)
+    updates = []
+
+    for kind in rng.choices(kinds, weights, k=args.updates):
+        if kind == 'admin':
+            uid = ADMIN_ID
+        elif rng.random() < args.new_users:
+            uid = next(new_ids)
+        else:
+            uid = rng.randint(2, max(2, users))
+        sender = {'id': uid, 'is_bot': False, 'first_name': f'name{uid}', 'username': f'user{uid}', 'language_code': 'ar'}
+        chat = {'id': uid, 'type': 'private'}
+        message = {'message_id': next(update_ids), 'date': int(time.time()), 'chat': chat, 'from': sender}
+
+        if kind == 'message':
+            data = {'message': dict(message, text=rng.choice(['مرحبا', 'hello', 'ℹ️ معلوماتي']))}
+        elif kind == 'link':
+            data = {'message': dict(message, text=f'https://www.youtube.com/watch?v={rng.choice(videos)}')}
+        else:
+            if kind == 'button':
+                callback = f"{rng.choice(['video', 'audio'])}_{rng.choice(tokens)}"
+            else:
+                callback = rng.choice(['general_stats', 'list_users'])
+            bot_message = {'message_id': next(update_ids), 'date': int(time.time()), 'chat': chat, 'text': '...'}
+            data = {'callback_query': {'id': str(next(update_ids)), 'from': sender, 'chat_instance': str(uid),
+                                       'data': callback, 'message': bot_message}}
+        updates.append((kind, Update.de_json(dict(data, update_id=next(update_ids)), fake_bot)))
+    return updates
+
+
+def wait_for_downloads(bot, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = bot.download_scheduler.stats()
+        if not stats['pending'] and not stats['active']:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def run_once(args, users):
+    """قياس واحد داخل عملية مستقلة، ويطبع النتيجة بصيغة JSON"""
+    configure_environment(tempfile.mkdtemp(prefix=f'bot-bench-{users}-'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    StubYoutubeDL.size = args.media_size
+    StubYoutubeDL.delay = args.download_delay
+    StubYoutubeDL.steps = args.progress_steps
+    bot.load_yt_dlp().YoutubeDL = StubYoutubeDL
+
+    load_seconds = populate(bot, users)
+    fake_bot = FakeBot()
+    bot.download_scheduler.start()
+    bot.users_writer.start()
+    updates = build_updates(args, users, fake_bot, bot)
+    context = SimpleNamespace(bot=fake_bot, args=[], user_data={}, chat_data={}, bot_data={})
+    handlers = {
+        'message': bot.handle_message,
+        'link': bot.handle_message,
+        'button': bot.handle_button,
+        'admin': bot.handle_admin_buttons,
+    }
+
+    latencies = {kind: [] for kind in handlers}
+    rss_before = read_rss()
+    io_before = read_proc_io()
+    started = time.perf_counter()
+    for kind, update in updates:
+        t0 = time.perf_counter()
+        handlers[kind](update, context)
+        latencies[kind].append(time.perf_counter() - t0)
+    handler_seconds = time.perf_counter() - started
+
+    drained = wait_for_downloads(bot)
+    total_seconds = time.perf_counter() - started
+    bot.users_writer.flush()
+    io_after = read_proc_io()
+    rss_after = read_rss()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        'users': users,
+        'updates': len(updates),
+        'load_seconds': round(load_seconds, 3),
+        'updates_per_second': round(len(updates) / handler_seconds, 1),
+        'p50_ms': round(percentile(all_latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(all_latencies, 99) * 1000, 3),
+        'per_kind_p99_ms': {kind: round(percentile(values, 99) * 1000, 3) for kind, values in latencies.items() if values},
+        'drain_seconds': round(total_seconds - handler_seconds, 3),
+        'downloads_drained': drained,
+        'rss_mb': round(rss_after / 1048576, 1),
+        'rss_growth_mb': round((rss_after - rss_before) / 1048576, 1),
+        'api_calls': fake_bot.calls,
+        'jobs': {dict(labels).get('outcome'): value for (name, labels), value in bot.metrics.counters.items()
+                 if name == 'bot_jobs_total'},
+    }
+    if io_before and io_after:
+        # كتابات الملفات الوهمية تطرح حتى يبقى ما يكتبه البوت نفسه (قاعدة البيانات والذاكرة المؤقتة)
+        written = io_after['wchar'] - io_before['wchar'] - StubYoutubeDL.bytes_written
+        result['write_bytes_per_update'] = round(written / len(updates), 1)
+        result['write_calls_per_update'] = round((io_after['syscw'] - io_before['syscw']) / len(updates), 3)
+    print(json.dumps(result, ensure_ascii=False))
+
+
+def run_all(args):
+    results = []
+    for users in args.users:
+        command = [sys.executable, os.path.abspath(__file__), '--run', str(users),
+                   '--updates', str(args.updates), '--mix', args.mix, '--videos', str(args.videos),
+                   '--new-users', str(args.new_users), '--media-size', str(args.media_size),
+                   '--download-delay', str(args.download_delay), '--progress-steps', str(args.progress_steps),
+                   '--seed', str(args.seed)]
+        print(f'⏳ {users} مستخدم...', file=sys.stderr)
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def print_table(results):
+    columns = [
+        ('users', 'users'), ('load_seconds', 'load s'), ('updates_per_second', 'updates/s'),
+        ('p50_ms', 'p50 ms'), ('p99_ms', 'p99 ms'), ('rss_mb', 'RSS MB'), ('rss_growth_mb', 'RSS +MB'),
+        ('write_bytes_per_update', 'B written/upd'), ('write_calls_per_update', 'writes/upd'),
+        ('drain_seconds', 'drain s'),
+    ]
+    rows = [[title for _, title in columns]] + [[str(result.get(key, 'n/a')) for key, _ in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+    for result in results:
+        print(f"\n{result['users']} users: p99 per handler {result['per_kind_p99_ms']}, "
+              f"jobs {result['jobs']}, API calls {result['api_calls']}")
+
+
+def compare(results, baseline_path, tolerance):
+    """مقارنة النتائج بقياس سابق وإرجاع قائمة التراجعات"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {result['users']: result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        old = baseline.get(result['users'])
+        if not old:
+            continue
+        if result['updates_per_second'] < old['updates_per_second'] * (1 - tolerance):
+            regressions.append(f"{result['users']} users: updates/s {old['updates_per_second']} -> {result['updates_per_second']}")
+        if result['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{result['users']} users: p99 {old['p99_ms']} ms -> {result['p99_ms']} ms")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run is not None:
+        run_once(args, args.run)
+        return 0
+
+    results = run_all(args)
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f'❌ {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
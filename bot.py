@@ -1,16 +1,39 @@
 import os
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+from telegram import Bot, InputFile, Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
-import yt_dlp
-from datetime import datetime
+from datetime import datetime, timedelta
 import concurrent.futures
-import queue
+import multiprocessing
 import asyncio
+import functools
 from dotenv import load_dotenv
 import json
+import copy
+import hashlib
+import sqlite3
 from pathlib import Path
 import time
+import threading
+import bisect
+import shutil
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque, namedtuple
+import re
+import math
+import uuid
+import secrets
+import hmac
+import signal
+import socket
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from telegram.error import TelegramError, RetryAfter, Unauthorized, BadRequest
+from telegram.utils.request import Request
 
 # تحميل المتغيرات البيئية
 load_dotenv()
@@ -22,62 +45,2186 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+yt_dlp = None  # يستورد عند أول استخدام لأنه يضاعف وقت تشغيل البوت
+
+def load_yt_dlp():
+    """استيراد yt-dlp عند الحاجة فقط"""
+    global yt_dlp
+    if yt_dlp is None:
+        import yt_dlp as module
+        yt_dlp = module
+    return yt_dlp
+
 # إعداد المتغيرات العامة
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 ADMIN_ID = os.getenv('ADMIN_ID')
 
-# إنشاء مجمع المهام
-download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+# مقاييس التشغيل بصيغة Prometheus (0 = معطل)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Metrics:
+    """عدادات ومدرجات زمنية في الذاكرة تعرض بصيغة Prometheus النصية"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}  # (الاسم، التصنيفات) -> القيمة
+        self.histograms = {}  # (الاسم، التصنيفات) -> [عدادات الفئات، المجموع، العدد]
+        self.gauges = {}  # الاسم -> دالة ترجع {التصنيفات: القيمة}
+        self.help = {}  # الاسم -> (النوع، الوصف)
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[0][i] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """قياس زمن مرحلة وعدد طلباتها مع حالة النجاح أو الفشل"""
+        start = time.monotonic()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            self.observe('bot_stage_duration_seconds', time.monotonic() - start, stage=stage, **labels)
+            self.inc('bot_stage_requests_total', stage=stage, status=status, **labels)
+
+    def register(self, name, kind, text, func):
+        """تسجيل مقياس تحسب قيمته عند القراءة فقط"""
+        self.describe(name, kind, text)
+        self.gauges[name] = func
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        """إخراج جميع المقاييس بصيغة Prometheus النصية"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self.histograms.items())
+        lines = []
+        seen = set()
+        
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                text = self.help.get(name, (kind, name))[1]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+        
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, 'histogram')
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {bucket_count}')
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{self._labels(labels)} {round(total, 6)}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        for name, func in self.gauges.items():
+            try:
+                values = func()
+            except Exception as e:
+                logger.warning(f"تعذر قراءة المقياس {name}: {str(e)}")
+                continue
+            header(name, self.help[name][0])
+            for labels, value in values.items():
+                lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('bot_stage_requests_total', 'counter', 'Requests per pipeline stage and status')
+metrics.describe('bot_stage_duration_seconds', 'histogram', 'Latency per pipeline stage')
+metrics.describe('bot_downloaded_bytes_total', 'counter', 'Bytes downloaded by yt-dlp')
+metrics.describe('bot_uploaded_bytes_total', 'counter', 'Bytes uploaded to Telegram')
+metrics.describe('bot_jobs_total', 'counter', 'Download jobs by platform and outcome')
+metrics.describe('bot_telegram_api_errors_total', 'counter', 'Telegram API errors by type')
+metrics.describe('bot_telegram_retry_after_total', 'counter', 'RetryAfter (flood control) responses')
+metrics.describe('bot_admission_rejected_total', 'counter', 'Requests rejected by rate limits per scope')
+
+def record_api_error(error):
+    """عد أخطاء Bot API حسب نوعها"""
+    if isinstance(error, RetryAfter):
+        metrics.inc('bot_telegram_retry_after_total')
+    metrics.inc('bot_telegram_api_errors_total', error=type(error).__name__)
+
+class MetricsRequest(Request):
+    """اتصال Bot API يعد الأخطاء وردود RetryAfter لجميع الطلبات"""
+
+    __slots__ = ()
+
+    def _request_wrapper(self, *args, **kwargs):
+        try:
+            return super()._request_wrapper(*args, **kwargs)
+        except TelegramError as e:
+            record_api_error(e)
+            raise
+
+class PooledRequest(MetricsRequest):
+    """مجمعا اتصالات منفصلان: الطلبات الصغيرة (تعديل، رد، إرسال معرف ملف) ورفع الملفات
+    
+    رفع ملف كبير يحجز اتصالاً لدقائق، لذلك لا يشارك المجمع مع تعديلات التقدم والردود.
+    """
+
+    __slots__ = ('media_request', 'media_read_timeout')
+
+    def __init__(self, media_request, media_read_timeout, **kwargs):
+        super().__init__(**kwargs)
+        self.media_request = media_request
+        self.media_read_timeout = media_read_timeout
+
+    def post(self, url, data, timeout=None):
+        if data and any(isinstance(value, InputFile) for value in data.values()):
+            return self.media_request.post(url, data, max(timeout or 0, self.media_read_timeout))
+        return super().post(url, data, timeout)
+
+# إعدادات طابور التحميل
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '3'))
+DOWNLOAD_QUEUE_SIZE = int(os.getenv('DOWNLOAD_QUEUE_SIZE', '50'))
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', '2'))
+JOB_MAX_RESUMES = int(os.getenv('JOB_MAX_RESUMES', '2'))  # مرات استكمال المهمة بعد إعادة التشغيل قبل إلغائها
+JOBS_DB_FILE = os.getenv('JOBS_DB_FILE', 'download_jobs.db')  # سجل مهام التحميل
+
+# وضع الرفع المتدفق: صيغ لا تحتاج دمجاً أو تحويلاً ورفع الملف على أجزاء
+STREAMING_PIPELINE = os.getenv('STREAMING_PIPELINE', '0') == '1'
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(256 * 1024)))
+UPLOAD_TIMEOUT = float(os.getenv('UPLOAD_TIMEOUT', '300'))
+
+# اتصالات Bot API: مجمع للطلبات الصغيرة ومجمع منفصل لرفع الملفات
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '0'))  # 0 = حسب عدد الخيوط التي تستدعي Bot API
+API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', '5'))
+API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', '10'))
+MEDIA_POOL_SIZE = int(os.getenv('MEDIA_POOL_SIZE', '0'))  # 0 = عدد عمال التحميل + 1
+MEDIA_CONNECT_TIMEOUT = float(os.getenv('MEDIA_CONNECT_TIMEOUT', '10'))
+
+# صيغ التحميل من يوتيوب
+CLASSIC_FORMATS = {
+    'video': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best',
+    'audio': 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best',
+}
+STREAMING_FORMATS = {
+    'video': 'best[ext=mp4][vcodec!=none][acodec!=none]/bestvideo[ext=mp4]+bestaudio[ext=m4a]/best',
+    'audio': 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best',
+}
+YOUTUBE_FORMATS = STREAMING_FORMATS if STREAMING_PIPELINE else CLASSIC_FORMATS
+
+# حد حجم الملفات التي يمكن رفعها عبر Bot API (50 MB للخادم العام)
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(50 * 1024 * 1024)))
+MP3_BITRATE = 192  # kbit/s كما في خيار التحويل إلى mp3
+
+# إعدادات مساحة التحميل
+SCRATCH_ROOT = os.getenv('SCRATCH_ROOT', 'downloads')
+DISK_QUOTA_BYTES = int(os.getenv('DISK_QUOTA_BYTES', str(2 * 1024 * 1024 * 1024)))
+DISK_WAIT_TIMEOUT = float(os.getenv('DISK_WAIT_TIMEOUT', '600'))  # أقصى انتظار لتوفر المساحة
+ORPHAN_MAX_AGE = int(os.getenv('ORPHAN_MAX_AGE', '3600'))  # عمر الملفات المهملة قبل حذفها
+JANITOR_INTERVAL = int(os.getenv('JANITOR_INTERVAL', '600'))
+
+class DiskQuotaError(Exception):
+    """لم تتوفر مساحة تخزين للمهمة خلال مدة الانتظار"""
+
+class StorageManager:
+    """إدارة مساحة التحميل: مجلد مؤقت لكل مهمة وحد عام للحجم ومنظف للملفات المهملة"""
+
+    def __init__(self, root, quota, orphan_age=3600):
+        self.root = Path(root)
+        self.quota = quota
+        self.orphan_age = orphan_age
+        self.reserved = 0
+        self.active = {}  # مجلد المهمة -> الحجم المحجوز
+        self.cond = threading.Condition()
+
+    def _has_room(self, nbytes):
+        if self.reserved + nbytes > self.quota:
+            return False
+        try:
+            return shutil.disk_usage(self.root).free >= nbytes
+        except OSError:
+            return True
+
+    @staticmethod
+    def dir_name(name):
+        return f'job-{name}'
+
+    def acquire(self, nbytes, timeout=DISK_WAIT_TIMEOUT, on_wait=None, name=None):
+        """حجز مساحة وإنشاء مجلد المهمة، مع الانتظار إذا كانت المساحة ممتلئة
+        
+        المهام المسجلة تستخدم اسماً ثابتاً (name) حتى تبقى الأجزاء المحملة متاحة بعد إعادة التشغيل.
+        """
+        nbytes = min(nbytes, self.quota)
+        self.root.mkdir(parents=True, exist_ok=True)
+        deadline = time.monotonic() + timeout
+        job_dir = self.root / self.dir_name(name or uuid.uuid4().hex)
+        with self.cond:
+            # المجلد المحجوز بعد إعادة التشغيل يحسب حجمه ضمن الحجز الجديد
+            full = not self._has_room(nbytes - self.active.get(job_dir, 0))
+        if full and on_wait:
+            # إبلاغ المستخدم خارج القفل حتى لا يوقف طلب تيليجرام بطيء حجز المهام الأخرى وتحريرها
+            on_wait()
+        with self.cond:
+            held = self.active.get(job_dir, 0)
+            while not self._has_room(nbytes - held):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DiskQuotaError()
+                # إعادة فحص المساحة الفعلية دورياً لأن ملفات أخرى قد تحذف
+                self.cond.wait(min(remaining, 5))
+            self.reserved += nbytes - held
+            self.active[job_dir] = nbytes
+        job_dir.mkdir(parents=True, exist_ok=True)
+        return job_dir
+
+    def hold(self, name):
+        """حجز مجلد مهمة مستكملة بحجمه الحالي حتى لا يحذفه المنظف قبل أن تبدأ"""
+        job_dir = self.root / self.dir_name(name)
+        try:
+            size = sum(path.stat().st_size for path in job_dir.rglob('*') if path.is_file())
+        except OSError:
+            size = 0
+        with self.cond:
+            self.reserved += size - self.active.get(job_dir, 0)
+            self.active[job_dir] = size
+        return job_dir
+
+    def release(self, job_dir):
+        """حذف مجلد المهمة وتحرير المساحة المحجوزة"""
+        shutil.rmtree(job_dir, ignore_errors=True)
+        with self.cond:
+            self.reserved -= self.active.pop(job_dir, 0)
+            self.cond.notify_all()
+
+    @contextmanager
+    def job(self, nbytes, timeout=DISK_WAIT_TIMEOUT, on_wait=None, name=None):
+        """مجلد مؤقت للمهمة يحذف مع جميع محتوياته عند الانتهاء"""
+        job_dir = self.acquire(nbytes, timeout, on_wait, name)
+        try:
+            yield str(job_dir)
+        finally:
+            self.release(job_dir)
+
+    def sweep(self):
+        """حذف المجلدات والملفات المهملة الأقدم من الحد المسموح"""
+        cutoff = time.time() - self.orphan_age
+        with self.cond:
+            active = set(self.active)
+        # يشمل المجلدات القديمة downloads/{chat_id} و downloads_{user_id}
+        candidates = list(self.root.iterdir()) if self.root.exists() else []
+        candidates += list(Path.cwd().glob('downloads_*'))
+        removed = 0
+        for path in candidates:
+            if path in active:
+                continue
+            try:
+                if path.stat().st_mtime > cutoff:
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink()
+                removed += 1
+            except OSError:
+                continue
+        if removed:
+            logger.info(f"تم حذف {removed} من ملفات التحميل المهملة")
+            with self.cond:
+                self.cond.notify_all()
+        return removed
+
+    def purge(self, keep=()):
+        """حذف جميع ملفات التحميل عدا مجلدات المهام المستكملة (عند بدء التشغيل فقط)"""
+        removed = 0
+        for path in (list(self.root.iterdir()) if self.root.exists() else []):
+            if path.name in keep:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+            removed += 1
+        if removed:
+            logger.info(f"تم حذف {removed} من ملفات التحميل غير المكتملة")
+        return removed
+
+    def start_janitor(self, interval=JANITOR_INTERVAL):
+        """تشغيل المنظف الدوري في الخلفية"""
+        def run():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"خطأ في تنظيف ملفات التحميل: {str(e)}")
+                time.sleep(interval)
+        threading.Thread(target=run, name='storage-janitor', daemon=True).start()
+
+    def stats(self):
+        with self.cond:
+            return {'reserved': self.reserved, 'quota': self.quota, 'jobs': len(self.active)}
+
+storage = StorageManager(SCRATCH_ROOT, DISK_QUOTA_BYTES, ORPHAN_MAX_AGE)
+
+# عدد عمليات التحميل المنفصلة (0 = داخل عملية البوت)
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '0'))
+
+class QueueFullError(Exception):
+    """الطابور ممتلئ ولا يقبل مهام جديدة"""
+
+class UserLimitError(Exception):
+    """المستخدم وصل للحد الأقصى من التحميلات المتزامنة"""
+
+class JobJournal:
+    """سجل دائم لمهام التحميل في الطابور المحلي لاستكمالها أو إنهائها بعد إعادة التشغيل
+    
+    ملف منفصل عن بيانات المستخدمين حتى لا ينتظر تسجيل المهمة كتابة دفعات المستخدمين.
+    عامل التحميل يربط معرف المهمة بالخيط الحالي، فتسجل دوال المهام مراحلها دون تمريره.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS download_jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, chat_id INTEGER, status_message_id INTEGER, '
+                "kind TEXT NOT NULL, payload TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'queued', "
+                'attempts INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)'
+            )
+            # الطلبات التي تنتظر نتيجة تحميل مشترك، حتى يصلها الملف أو رسالة واضحة بعد إعادة التشغيل
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS download_followers ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, flight TEXT NOT NULL, user_id INTEGER, message TEXT NOT NULL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS download_followers_flight ON download_followers (flight)')
+
+    def record(self, user_id, func, args):
+        """تسجيل مهمة جديدة، ويرجع None إذا تعذر حفظها (تنفذ دون استكمال بعد إعادة التشغيل)"""
+        status_message = next((arg for arg in args if isinstance(arg, Message)), None)
+        try:
+            payload = json.dumps([encode_job_arg(arg) for arg in args], ensure_ascii=False)
+            with self.lock, self.conn:
+                return self.conn.execute(
+                    'INSERT INTO download_jobs (user_id, chat_id, status_message_id, kind, payload, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (user_id, status_message.chat_id if status_message else None,
+                     status_message.message_id if status_message else None,
+                     func.__name__, payload, time.time())
+                ).lastrowid
+        except (TypeError, ValueError, sqlite3.Error) as e:
+            logger.error(f"خطأ في تسجيل مهمة التحميل: {str(e)}")
+            return None
+
+    def mark(self, job_id, job_state, attempts=None):
+        """تحديث حالة المهمة (queued أو downloading أو uploading أو done أو failed)"""
+        if job_id is None:
+            return
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    'UPDATE download_jobs SET state = ?, attempts = COALESCE(?, attempts), updated = ? WHERE id = ?',
+                    (job_state, attempts, time.time(), job_id)
+                )
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في تحديث سجل المهمة {job_id}: {str(e)}")
+
+    def add_follower(self, flight, status_message, user_id):
+        """تسجيل طلب ينتظر نتيجة التحميل المشترك flight"""
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    'INSERT INTO download_followers (flight, user_id, message) VALUES (?, ?, ?)',
+                    (flight, user_id, json.dumps(status_message.to_dict(), ensure_ascii=False))
+                )
+        except (TypeError, ValueError, sqlite3.Error) as e:
+            logger.error(f"خطأ في تسجيل طلب مشترك: {str(e)}")
+
+    def drop_followers(self, flight):
+        """حذف طلبات التحميل المشترك بعد إيصال النتيجة"""
+        try:
+            with self.lock, self.conn:
+                self.conn.execute('DELETE FROM download_followers WHERE flight = ?', (flight,))
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في حذف الطلبات المشتركة: {str(e)}")
+
+    def followers(self):
+        """الطلبات المحفوظة مجمعة حسب التحميل: flight -> [(بيانات الرسالة، المستخدم)]"""
+        with self.lock:
+            rows = self.conn.execute('SELECT flight, user_id, message FROM download_followers ORDER BY id').fetchall()
+        grouped = {}
+        for flight, user_id, message in rows:
+            grouped.setdefault(flight, []).append((json.loads(message), user_id))
+        return grouped
+
+    def unfinished(self):
+        """حذف المهام المنتهية وإرجاع المهام التي قطعها إيقاف البوت"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM download_jobs WHERE state IN ('done', 'failed')")
+            self.conn.row_factory = sqlite3.Row
+            try:
+                rows = self.conn.execute('SELECT * FROM download_jobs ORDER BY id').fetchall()
+            finally:
+                self.conn.row_factory = None
+        return [dict(row) for row in rows]
+
+    @contextmanager
+    def bind(self, job_id):
+        self.local.job_id = job_id
+        try:
+            yield
+        finally:
+            self.local.job_id = None
+
+    def current(self):
+        """معرف المهمة الجارية على هذا الخيط أو None"""
+        return getattr(self.local, 'job_id', None)
+
+    def stage(self, job_state):
+        """تسجيل مرحلة المهمة الجارية على هذا الخيط (لا شيء خارج الطابور المحلي)"""
+        self.mark(self.current(), job_state)
+
+job_journal = JobJournal(JOBS_DB_FILE)
+
+class DownloadScheduler:
+    """جدولة التحميلات على عمال منفصلين عن خيوط معالجة التحديثات"""
+
+    def __init__(self, workers=3, max_pending=50, per_user=2):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.per_user = per_user
+        self.pending = deque()  # (user_id, func, args, معرف المهمة في السجل)
+        self.user_jobs = {}  # user_id -> عدد المهام المنتظرة والجارية
+        self.active = 0
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        """تشغيل عمال التحميل"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'download-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, user_id, func, *args):
+        """إضافة مهمة وإرجاع عدد المهام التي تسبقها (0 = تبدأ فوراً)"""
+        with self.cond:
+            if self.user_jobs.get(user_id, 0) >= self.per_user:
+                raise UserLimitError()
+            if len(self.pending) >= self.max_pending:
+                raise QueueFullError()
+            job_id = job_journal.record(user_id, func, args)
+            self.pending.append((user_id, func, args, job_id))
+            self.user_jobs[user_id] = self.user_jobs.get(user_id, 0) + 1
+            position = max(0, len(self.pending) - (self.workers - self.active))
+            self.cond.notify()
+        return position
+
+    def requeue(self, job_id, user_id, func, *args):
+        """إعادة مهمة مسجلة إلى الطابور بعد إعادة التشغيل دون فحص الحدود"""
+        with self.cond:
+            self.pending.append((user_id, func, args, job_id))
+            self.user_jobs[user_id] = self.user_jobs.get(user_id, 0) + 1
+            self.cond.notify()
+
+    def stats(self):
+        """حالة الطابور الحالية"""
+        with self.cond:
+            return {'pending': len(self.pending), 'active': self.active, 'workers': self.workers}
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                user_id, func, args, job_id = self.pending.popleft()
+                self.active += 1
+            try:
+                job_journal.mark(job_id, 'downloading')
+                with job_journal.bind(job_id):
+                    func(*args)
+            except Exception as e:
+                logger.error(f"خطأ في مهمة التحميل: {str(e)}")
+            finally:
+                # المهمة التي قطعها إيقاف البوت لا تصل إلى هنا وتبقى في السجل لاستكمالها
+                job_journal.mark(job_id, 'done')
+                if job_id is not None:
+                    # مجلد المهمة المستكملة يبقى محجوزاً حتى لو انتهت دون أن تستخدمه
+                    storage.release(storage.root / storage.dir_name(job_id))
+                with self.cond:
+                    self.active -= 1
+                    self.user_jobs[user_id] -= 1
+                    if not self.user_jobs[user_id]:
+                        del self.user_jobs[user_id]
+
+# الحالة المشتركة بين عدة نسخ من البوت على جهاز واحد أو أكثر
+SHARED_STATE = os.getenv('SHARED_STATE', '0') == '1'
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', 'bot_state.db')
+KV_PURGE_EVERY = 256  # عدد عمليات الكتابة بين كل حذف للقيم المنتهية
+BOT_ROLE = os.getenv('BOT_ROLE', 'all')  # all أو handler (التحديثات فقط) أو worker (التحميلات فقط)
+JOB_LEASE = float(os.getenv('JOB_LEASE', '90'))  # تجدد أثناء التحميل، وبعدها تعاد المهمة للطابور إذا توقفت النسخة
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+class StateBackend(ABC):
+    """واجهة الحالة المشتركة: قيم بمدة صلاحية وعدادات ومجموعات انتظار وطابور مهام
+    
+    القيم يجب أن تكون قابلة للتحويل إلى JSON، وكل تطبيق جديد يضاف إلى STATE_BACKENDS.
+    """
+
+    def open(self):
+        pass
+
+    @abstractmethod
+    def get(self, key, default=None):
+        """إرجاع القيمة أو default إذا لم تكن موجودة أو انتهت صلاحيتها"""
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        """حفظ القيمة مع مدة صلاحية اختيارية بالثواني"""
+
+    @abstractmethod
+    def add(self, key, value, ttl=None):
+        """الحفظ فقط إذا لم يكن المفتاح موجوداً، ويرجع True عند النجاح"""
+
+    @abstractmethod
+    def delete(self, key):
+        """حذف المفتاح إن وجد"""
+
+    @abstractmethod
+    def pop(self, key, default=None):
+        """حذف المفتاح وإرجاع قيمته"""
+
+    @abstractmethod
+    def incr(self, name, amount=1, initial=0):
+        """زيادة عداد وإرجاع قيمته الجديدة (initial = قيمته إذا لم يكن موجوداً)"""
+
+    @abstractmethod
+    def join_group(self, key, member, ttl=None):
+        """أول مستدعٍ يصبح القائد (True) والباقون يضافون كأعضاء ينتظرون"""
+
+    @abstractmethod
+    def close_group(self, key):
+        """إغلاق المجموعة وإرجاع أعضائها"""
+
+    @abstractmethod
+    def enqueue(self, user_id, kind, payload, max_pending, per_user):
+        """إضافة مهمة وإرجاع عدد المهام المنتظرة قبلها"""
+
+    @abstractmethod
+    def claim(self, owner, lease):
+        """سحب أقدم مهمة منتظرة أو منتهية المهلة، ويرجع (المعرف، النوع، البيانات) أو None"""
+
+    @abstractmethod
+    def renew(self, job_id, owner, lease):
+        """تمديد مهلة مهمة جارية، ويرجع False إذا لم تعد ملكاً لهذه النسخة"""
+
+    @abstractmethod
+    def complete(self, job_id, owner):
+        """حذف المهمة بعد انتهائها إذا كانت ما تزال ملكاً لهذه النسخة"""
+
+    @abstractmethod
+    def queue_stats(self):
+        """عدد المهام المنتظرة والجارية {'pending', 'running'}"""
+
+class SQLiteStateBackend(StateBackend):
+    """الحالة المشتركة في ملف SQLite لعدة عمليات على الجهاز نفسه"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        # autocommit مع BEGIN IMMEDIATE للعمليات المركبة حتى لا تتداخل العمليات الأخرى
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS group_members ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, member TEXT NOT NULL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS group_members_key ON group_members (key)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, kind TEXT NOT NULL, payload TEXT NOT NULL, '
+                "status TEXT NOT NULL DEFAULT 'pending', owner TEXT, lease_until REAL, created REAL NOT NULL)"
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+    @contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    @staticmethod
+    def _expires(ttl):
+        return time.time() + ttl if ttl else None
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value, expires FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), self._expires(ttl))
+            )
+            # حذف القيم المنتهية من حين لآخر حتى لا تكبر القاعدة بمعلومات الفيديو والرموز القديمة
+            self.writes += 1
+            if self.writes % KV_PURGE_EVERY == 0:
+                self.conn.execute('DELETE FROM kv WHERE expires <= ?', (time.time(),))
+
+    def add(self, key, value, ttl=None):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM kv WHERE key = ? AND expires <= ?', (key, time.time()))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), self._expires(ttl))
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def pop(self, key, default=None):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT value, expires FROM kv WHERE key = ?', (key,)).fetchone()
+            conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return json.loads(row[0])
+
+    def incr(self, name, amount=1, initial=0):
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)', (name, initial))
+            conn.execute('UPDATE counters SET value = value + ? WHERE name = ?', (amount, name))
+            return conn.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()[0]
+
+    def join_group(self, key, member, ttl=None):
+        with self._transaction() as conn:
+            now = time.time()
+            expired = conn.execute('DELETE FROM kv WHERE key = ? AND expires <= ?', (f'group:{key}', now)).rowcount
+            if expired:
+                conn.execute('DELETE FROM group_members WHERE key = ?', (key,))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                (f'group:{key}', json.dumps(INSTANCE_ID), self._expires(ttl))
+            )
+            if cursor.rowcount == 1:
+                return True
+            conn.execute(
+                'INSERT INTO group_members (key, member) VALUES (?, ?)',
+                (key, json.dumps(member, ensure_ascii=False))
+            )
+            return False
+
+    def close_group(self, key):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM kv WHERE key = ?', (f'group:{key}',))
+            rows = conn.execute('SELECT member FROM group_members WHERE key = ? ORDER BY id', (key,)).fetchall()
+            conn.execute('DELETE FROM group_members WHERE key = ?', (key,))
+        return [json.loads(member) for member, in rows]
+
+    def enqueue(self, user_id, kind, payload, max_pending, per_user):
+        with self._transaction() as conn:
+            user_jobs = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN ('pending', 'running')", (user_id,)
+            ).fetchone()[0]
+            if user_jobs >= per_user:
+                raise UserLimitError()
+            pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+            if pending >= max_pending:
+                raise QueueFullError()
+            conn.execute(
+                'INSERT INTO jobs (user_id, kind, payload, created) VALUES (?, ?, ?, ?)',
+                (user_id, kind, json.dumps(payload, ensure_ascii=False), time.time())
+            )
+        return pending
+
+    def claim(self, owner, lease):
+        with self._transaction() as conn:
+            now = time.time()
+            row = conn.execute(
+                "SELECT id, kind, payload FROM jobs WHERE status = 'pending' "
+                "OR (status = 'running' AND lease_until < ?) ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ? WHERE id = ?",
+                (owner, now + lease, row[0])
+            )
+        return row[0], row[1], json.loads(row[2])
+
+    def renew(self, job_id, owner, lease):
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time() + lease, job_id, owner)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, owner):
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE id = ? AND owner = ?', (job_id, owner))
+
+    def queue_stats(self):
+        with self.lock:
+            counts = dict(self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {'pending': counts.get('pending', 0), 'running': counts.get('running', 0)}
+
+STATE_BACKENDS = {'sqlite': lambda: SQLiteStateBackend(STATE_DB_FILE)}
+
+def create_state_backend(name):
+    """إنشاء الحالة المشتركة حسب STATE_BACKEND"""
+    if name not in STATE_BACKENDS:
+        raise SystemExit(f"STATE_BACKEND غير معروف: {name}")
+    return STATE_BACKENDS[name]()
+
+state = create_state_backend(STATE_BACKEND)
+
+def encode_job_arg(value):
+    """تحويل معامل مهمة إلى JSON لتنفذه أي نسخة من البوت"""
+    if isinstance(value, Bot):
+        return {'bot': True}
+    if isinstance(value, Message):
+        return {'message': value.to_dict()}
+    if isinstance(value, MediaLink):
+        return {'link': list(value)}
+    return {'value': value}
+
+def decode_job_arg(data, bot):
+    if 'bot' in data:
+        return bot
+    if 'message' in data:
+        return Message.de_json(data['message'], bot)
+    if 'link' in data:
+        return MediaLink(*data['link'])
+    return data['value']
+
+class SharedDownloadScheduler:
+    """طابور تحميل في الحالة المشتركة تسحب منه عمال جميع نسخ البوت
+    
+    نفس واجهة DownloadScheduler، لكن المهام تحفظ كبيانات JSON وتنفذ بالدوال المسجلة في JOB_FUNCTIONS.
+    """
+
+    def __init__(self, state, workers=3, max_pending=50, per_user=2, lease=1800, poll_interval=1.0):
+        self.state = state
+        self.workers = workers
+        self.max_pending = max_pending
+        self.per_user = per_user
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.active = 0
+        self.running = set()  # المهام التي تنفذها هذه النسخة وتجدد مهلتها
+        self.bot = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def start(self, bot):
+        """تشغيل عمال التحميل في هذه النسخة"""
+        self.bot = bot
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'download-worker-{i}', daemon=True).start()
+        if self.workers:
+            threading.Thread(target=self._heartbeat, name='download-heartbeat', daemon=True).start()
+
+    def _heartbeat(self):
+        """تجديد مهلة المهام الجارية حتى لا يسحبها عامل آخر مهما طال التحميل"""
+        while True:
+            time.sleep(self.lease / 3)
+            with self.lock:
+                running = list(self.running)
+            for job_id in running:
+                try:
+                    if not self.state.renew(job_id, INSTANCE_ID, self.lease):
+                        logger.warning(f"مهمة التحميل {job_id} لم تعد لهذه النسخة")
+                except sqlite3.Error as e:
+                    logger.error(f"خطأ في تجديد مهلة مهمة التحميل {job_id}: {str(e)}")
+
+    def submit(self, user_id, func, *args):
+        """إضافة مهمة للطابور المشترك وإرجاع عدد المهام التي تسبقها"""
+        payload = [encode_job_arg(arg) for arg in args]
+        position = self.state.enqueue(user_id, func.__name__, payload, self.max_pending, self.per_user)
+        self.wakeup.set()
+        return position
+
+    def stats(self):
+        stats = self.state.queue_stats()
+        with self.lock:
+            return {'pending': stats['pending'], 'active': self.active, 'workers': self.workers}
+
+    def _worker(self):
+        while True:
+            try:
+                job = self.state.claim(INSTANCE_ID, self.lease)
+            except sqlite3.Error as e:
+                logger.error(f"خطأ في قراءة طابور التحميل المشترك: {str(e)}")
+                job = None
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+            
+            job_id, kind, payload = job
+            with self.lock:
+                self.active += 1
+                self.running.add(job_id)
+            try:
+                JOB_FUNCTIONS[kind](*(decode_job_arg(arg, self.bot) for arg in payload))
+            except Exception as e:
+                logger.error(f"خطأ في مهمة التحميل: {str(e)}")
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.running.discard(job_id)
+                self.state.complete(job_id, INSTANCE_ID)
+
+if SHARED_STATE:
+    download_scheduler = SharedDownloadScheduler(
+        state, DOWNLOAD_WORKERS if BOT_ROLE != 'handler' else 0,
+        DOWNLOAD_QUEUE_SIZE, MAX_JOBS_PER_USER, JOB_LEASE
+    )
+else:
+    download_scheduler = DownloadScheduler(DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE, MAX_JOBS_PER_USER)
+
+# حدود تعديل الرسائل في تيليجرام
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', '1'))  # لكل تحميل
+EDIT_CHAT_INTERVAL = float(os.getenv('EDIT_CHAT_INTERVAL', '1'))  # لكل محادثة
+EDIT_GLOBAL_RATE = float(os.getenv('EDIT_GLOBAL_RATE', '20'))  # تعديل في الثانية للبوت كاملاً
+
+class TokenBucket:
+    """دلو رموز للتحكم في معدل العمليات"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount=1):
+        """أخذ رمز إن وجد دون انتظار"""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True
+            return False
+
+    def wait_time(self, amount=1):
+        """الثواني المتبقية حتى يتوفر الرمز (0 = متوفر الآن)"""
+        with self.lock:
+            self._refill(time.monotonic())
+            return max(0.0, (amount - self.tokens) / self.rate)
+
+    def acquire(self, amount=1):
+        """الانتظار حتى يتوفر رمز"""
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+class EditRateLimiter:
+    """تحديد معدل تعديل الرسائل لكل محادثة وللبوت كاملاً لتجنب أخطاء Flood"""
+
+    def __init__(self, chat_interval=1.0, global_rate=20, max_chats=10000):
+        self.chat_interval = chat_interval
+        self.global_bucket = TokenBucket(global_rate)
+        self.max_chats = max_chats
+        self.chat_next = {}  # chat_id -> أقرب وقت مسموح فيه بالتعديل
+        self.lock = threading.Lock()
+
+    def try_acquire(self, chat_id):
+        """السماح بتعديل واحد إن لم يتجاوز الحدود"""
+        now = time.monotonic()
+        with self.lock:
+            if self.chat_next.get(chat_id, 0) > now:
+                return False
+            if not self.global_bucket.try_acquire():
+                return False
+            if len(self.chat_next) >= self.max_chats:
+                self.chat_next = {cid: t for cid, t in self.chat_next.items() if t > now}
+            self.chat_next[chat_id] = now + self.chat_interval
+            return True
+
+    def penalize(self, chat_id, seconds):
+        """إيقاف التعديل في المحادثة بعد خطأ RetryAfter"""
+        with self.lock:
+            self.chat_next[chat_id] = time.monotonic() + seconds
+
+edit_limiter = EditRateLimiter(EDIT_CHAT_INTERVAL, EDIT_GLOBAL_RATE)
+
+# حدود قبول الطلبات قبل بدء أي عمل مكلف (الروابط وأزرار التحميل)
+USER_REQUESTS_PER_MINUTE = float(os.getenv('USER_REQUESTS_PER_MINUTE', '6'))
+USER_REQUESTS_BURST = int(os.getenv('USER_REQUESTS_BURST', '3'))
+CHAT_REQUESTS_PER_MINUTE = float(os.getenv('CHAT_REQUESTS_PER_MINUTE', '20'))
+CHAT_REQUESTS_BURST = int(os.getenv('CHAT_REQUESTS_BURST', '6'))
+GLOBAL_REQUESTS_PER_SECOND = float(os.getenv('GLOBAL_REQUESTS_PER_SECOND', '5'))
+GLOBAL_REQUESTS_BURST = int(os.getenv('GLOBAL_REQUESTS_BURST', '20'))
+ADMISSION_MAX_KEYS = int(os.getenv('ADMISSION_MAX_KEYS', '50000'))
+
+class AdmissionController:
+    """دلاء رموز لكل مستخدم ولكل محادثة وللبوت كاملاً، ويقبل الطلب فقط إذا سمحت الثلاثة"""
+
+    def __init__(self, user_rate, user_burst, chat_rate, chat_burst, global_rate, global_burst, max_keys=50000):
+        self.user_limits = (user_rate, user_burst)
+        self.chat_limits = (chat_rate, chat_burst)
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_keys = max_keys
+        self.users = OrderedDict()  # user_id -> TokenBucket (الأقدم استخداماً أولاً)
+        self.chats = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _bucket(self, buckets, key, limits):
+        bucket = buckets.get(key)
+        if bucket is None:
+            # الدلو المحذوف كان ممتلئاً غالباً لأن صاحبه لم يرسل طلباً منذ مدة
+            if len(buckets) >= self.max_keys:
+                buckets.popitem(last=False)
+            bucket = buckets[key] = TokenBucket(*limits)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def admit(self, user_id, chat_id, cost=1):
+        """إرجاع (None, 0) عند القبول أو (النطاق، ثواني الانتظار) عند الرفض"""
+        with self.lock:
+            scopes = (
+                ('user', self._bucket(self.users, user_id, self.user_limits)),
+                ('chat', self._bucket(self.chats, chat_id, self.chat_limits)),
+                ('global', self.global_bucket),
+            )
+            for scope, bucket in scopes:
+                wait = bucket.wait_time(cost)
+                if wait > 0:
+                    metrics.inc('bot_admission_rejected_total', scope=scope)
+                    return scope, wait
+            for _, bucket in scopes:
+                bucket.try_acquire(cost)
+            return None, 0
+
+admission = AdmissionController(
+    USER_REQUESTS_PER_MINUTE / 60, USER_REQUESTS_BURST,
+    CHAT_REQUESTS_PER_MINUTE / 60, CHAT_REQUESTS_BURST,
+    GLOBAL_REQUESTS_PER_SECOND, GLOBAL_REQUESTS_BURST,
+    ADMISSION_MAX_KEYS
+)
+
+def admission_message(user_id, chat_id):
+    """فحص حدود الطلبات وإرجاع رسالة الرفض أو None عند القبول (المشرف مستثنى)"""
+    if str(user_id) == ADMIN_ID:
+        return None
+    scope, wait = admission.admit(user_id, chat_id)
+    if scope is None:
+        return None
+    seconds = max(1, math.ceil(wait))
+    if scope == 'global':
+        return f"⚠️ البوت مشغول حالياً بعدد كبير من الطلبات. الرجاء المحاولة بعد {seconds} ثانية."
+    return f"⏳ أرسلت طلبات كثيرة في وقت قصير. الرجاء المحاولة بعد {seconds} ثانية."
+
+# وضع asyncio: حلقة واحدة للمعالجات وتحديثات التقدم والرسائل الجماعية
+ASYNC_MODE = os.getenv('ASYNC_MODE', '0') == '1'
+ASYNC_API_CONCURRENCY = int(os.getenv('ASYNC_API_CONCURRENCY', '16'))
+
+class AsyncCore:
+    """حلقة asyncio واحدة تدير المعالجات وتعديلات التقدم والرسائل الجماعية كـ coroutines
+    
+    طلبات Bot API في python-telegram-bot 13 متزامنة، لذلك تنفذ على مجمع خيوط محدود
+    بدلاً من حجز خيط لكل محادثة، أما تحميلات yt-dlp و ffmpeg فتبقى على عمال التحميل.
+    """
+
+    def __init__(self, api_concurrency=16):
+        self.api_concurrency = api_concurrency
+        self.loop = None
+        self.api_executor = None
+        self.pending_edits = {}  # (chat_id, message_id) -> (الرسالة، آخر نص)
+
+    @property
+    def running(self):
+        return self.loop is not None
+
+    def start(self):
+        """تشغيل الحلقة في خيط مستقل"""
+        self.api_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.api_concurrency, thread_name_prefix='bot-api'
+        )
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+        
+        threading.Thread(target=run, name='asyncio-core', daemon=True).start()
+        ready.wait()
+        self.loop = loop
+
+    def submit(self, coro):
+        """جدولة coroutine على الحلقة من أي خيط"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def call(self, func, *args, **kwargs):
+        """تنفيذ استدعاء متزامن (Bot API أو قاعدة البيانات) دون إيقاف الحلقة"""
+        return await self.loop.run_in_executor(self.api_executor, functools.partial(func, *args, **kwargs))
+
+    def handler(self, func):
+        """تغليف معالج تيليجرام بحيث يتحرر خيط الموزع فوراً"""
+        @functools.wraps(func)
+        def callback(update, context):
+            self.submit(self._handle(func, update, context))
+        return callback
+
+    async def _handle(self, func, update, context):
+        try:
+            await self.call(func, update, context)
+        except Exception as e:
+            logger.error(f"خطأ في معالج {func.__name__}: {str(e)}")
+
+    def edit_later(self, message, text):
+        """طلب تعديل رسالة؛ إذا كان تعديل سابق جارياً يرسل آخر نص فقط"""
+        self.loop.call_soon_threadsafe(self._queue_edit, message, text)
+
+    def _queue_edit(self, message, text):
+        key = (message.chat_id, message.message_id)
+        idle = key not in self.pending_edits
+        self.pending_edits[key] = (message, text)
+        if idle:
+            self.loop.create_task(self._edit_worker(key))
+
+    async def _edit_worker(self, key):
+        while True:
+            message, text = self.pending_edits[key]
+            try:
+                await self.call(message.edit_text, text)
+            except RetryAfter as e:
+                edit_limiter.penalize(message.chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramError:
+                pass  # تجاهل أخطاء تحديث الرسالة
+            if self.pending_edits[key][1] == text:
+                del self.pending_edits[key]
+                return
+
+async_core = AsyncCore(ASYNC_API_CONCURRENCY)
+
+FLIGHT_TTL = int(os.getenv('FLIGHT_TTL', '1800'))  # أقصى مدة لاعتبار التحميل المشترك جارياً
+
+class InFlightDownloads:
+    """دمج الطلبات المتطابقة بحيث يعمل تحميل واحد ويشترك الباقون في تقدمه ونتيجته
+    
+    مع الحالة المشتركة يسجل الطلب في مجموعة مشتركة بين النسخ، ويصل المشتركين من نسخ أخرى
+    النتيجة فقط دون التقدم.
+    """
+
+    def __init__(self, shared=None):
+        self.shared = shared
+        self.flights = {}  # (المنصة، معرف الفيديو، نوع التحميل) -> {'trackers', 'followers'}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _group(key):
+        return 'flight:' + ':'.join(map(str, key))
+
+    def join(self, key, status_message, user_id):
+        """تسجيل الطلب ويرجع True إذا كان أول طلب (يجب عليه تنفيذ التحميل)"""
+        if self.shared:
+            member = {'message': status_message.to_dict(), 'user_id': user_id}
+            return self.shared.join_group(self._group(key), member, FLIGHT_TTL)
+        tracker = ProgressTracker(status_message)
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                self.flights[key] = {'trackers': [tracker], 'followers': []}
+                return True
+            flight['trackers'].append(tracker)
+            flight['followers'].append((status_message, user_id))
+        job_journal.add_follower(self._group(key), status_message, user_id)
+        return False
+
+    def restore(self, key, status_message, journaled, bot):
+        """إعادة تسجيل الطلبات المحفوظة لتحميل مستكمل بعد إعادة التشغيل (تحذف من journaled)"""
+        followers = [
+            (Message.de_json(message, bot), user_id) for message, user_id in journaled.pop(self._group(key), [])
+        ]
+        with self.lock:
+            self.flights[key] = {
+                'trackers': [ProgressTracker(status_message)] + [ProgressTracker(message) for message, _ in followers],
+                'followers': followers,
+            }
+        return len(followers)
+
+    def attach(self, key, status_message):
+        """تسجيل رسالة القائد في هذه النسخة إذا كان الطلب قد سجل في نسخة أخرى"""
+        with self.lock:
+            if key not in self.flights:
+                self.flights[key] = {'trackers': [ProgressTracker(status_message)], 'followers': []}
+
+    def progress_hook(self, key):
+        """دالة تقدم توزع بيانات yt-dlp على جميع المشتركين"""
+        def hook(d):
+            with self.lock:
+                flight = self.flights.get(key)
+                trackers = list(flight['trackers']) if flight else []
+            for tracker in trackers:
+                tracker.hook(d)
+        return hook
+
+    def finish(self, key, bot):
+        """إنهاء التحميل وإرجاع المشتركين الذين ينتظرون النتيجة"""
+        with self.lock:
+            flight = self.flights.pop(key, None)
+        followers = flight['followers'] if flight else []
+        if followers and not self.shared:
+            job_journal.drop_followers(self._group(key))
+        if self.shared:
+            followers += [
+                (Message.de_json(member['message'], bot), member['user_id'])
+                for member in self.shared.close_group(self._group(key))
+            ]
+        return followers
+
+    def count(self):
+        with self.lock:
+            return len(self.flights)
+
+in_flight = InFlightDownloads(state if SHARED_STATE else None)
+
+# إعدادات ذاكرة الوسائط المؤقتة
+MEDIA_CACHE_FILE = os.getenv('MEDIA_CACHE_FILE', 'media_cache.db')
+LEGACY_MEDIA_CACHE_FILE = 'media_cache.json'
+MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', '5000'))
+MEDIA_CACHE_TTL = int(os.getenv('MEDIA_CACHE_TTL', str(30 * 86400)))  # بالثواني
+
+class MediaCache:
+    """ذاكرة مؤقتة دائمة تربط كل فيديو بمعرف الملف الذي أعاده تيليجرام بعد أول رفع"""
+
+    def __init__(self, path, max_size=5000, ttl=30 * 86400, shared=None, legacy_path=None):
+        self.shared = shared  # مستوى ثانٍ مشترك بين نسخ البوت
+        self.path = path
+        self.legacy_path = Path(legacy_path) if legacy_path else None
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # المفتاح -> {'file_id', 'caption', 'created'}
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()  # يحفظ ترتيب الكتابة في القاعدة كترتيب التعديل في الذاكرة
+
+    @staticmethod
+    def make_key(extractor, video_id, download_type, format_spec):
+        """إنشاء مفتاح الذاكرة من (المستخرج، معرف الفيديو، نوع التحميل، الصيغة)"""
+        return f"{extractor}:{video_id}:{download_type}:{format_spec}"
+
+    def get(self, key):
+        """إرجاع العنصر المحفوظ (معرف الملف والوصف) أو None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry['created'] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry)
+            if entry:
+                del self.entries[key]
+        entry = self.shared.get(f'media:{key}') if self.shared else None
+        with self.lock:
+            if entry:
+                self.entries[key] = entry
+                self.hits += 1
+                return dict(entry)
+            self.misses += 1
+            return None
+
+    def put(self, key, file_id, caption=''):
+        """حفظ معرف الملف مع حذف الأقدم عند امتلاء الذاكرة"""
+        with self.db_lock:
+            evicted = []
+            with self.lock:
+                self.entries[key] = {'file_id': file_id, 'caption': caption, 'created': time.time()}
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    evicted.append(self.entries.popitem(last=False)[0])
+                entry = self.entries[key]
+            # كتابة العنصر الجديد وحذف ما خرج من الذاكرة فقط بدلاً من إعادة كتابة الذاكرة كاملة
+            self._write(
+                [(key, entry['file_id'], entry['caption'], entry['created'])],
+                evicted
+            )
+        if self.shared:
+            self.shared.set(f'media:{key}', entry, ttl=self.ttl)
+
+    def invalidate(self, key):
+        """حذف معرف ملف لم يعد صالحاً"""
+        with self.db_lock:
+            with self.lock:
+                self.entries.pop(key, None)
+            self._write((), [key])
+        if self.shared:
+            self.shared.delete(f'media:{key}')
+
+    def stats(self):
+        """إحصائيات الإصابة والإخفاق"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits * 100 / total, 1) if total else 0.0,
+            }
+
+    def load(self):
+        """فتح قاعدة الذاكرة وتحميل العناصر غير المنتهية، مع ترحيل ملف JSON القديم مرة واحدة"""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db_lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS media_cache ('
+                'key TEXT PRIMARY KEY, file_id TEXT NOT NULL, caption TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            empty = self.conn.execute('SELECT 1 FROM media_cache LIMIT 1').fetchone() is None
+            if empty and self.legacy_path and self.legacy_path.exists():
+                self._migrate()
+            cutoff = time.time() - self.ttl
+            self.conn.execute('DELETE FROM media_cache WHERE created <= ?', (cutoff,))
+            rows = self.conn.execute(
+                'SELECT key, file_id, caption, created FROM media_cache ORDER BY created'
+            ).fetchall()
+        with self.lock:
+            for key, file_id, caption, created in rows:
+                self.entries[key] = {'file_id': file_id, 'caption': caption, 'created': created}
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _migrate(self):
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"خطأ في تحميل ذاكرة الوسائط: {str(e)}")
+            return
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO media_cache (key, file_id, caption, created) VALUES (?, ?, ?, ?)',
+            (
+                (key, entry['file_id'], entry.get('caption', ''), entry.get('created', 0))
+                for key, entry in data.items()
+            )
+        )
+        logger.info(f"تم ترحيل {len(data)} عنصر من {self.legacy_path}")
+
+    def _write(self, rows, deleted):
+        """تطبيق التغييرات على القاعدة (يستدعى مع db_lock)"""
+        if self.conn is None:
+            return  # قبل load تبقى الذاكرة في الذاكرة فقط
+        try:
+            with self.conn:
+                self.conn.executemany('DELETE FROM media_cache WHERE key = ?', ((key,) for key in deleted))
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO media_cache (key, file_id, caption, created) VALUES (?, ?, ?, ?)', rows
+                )
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في حفظ ذاكرة الوسائط: {str(e)}")
+
+media_cache = MediaCache(
+    MEDIA_CACHE_FILE, MEDIA_CACHE_SIZE, MEDIA_CACHE_TTL, state if SHARED_STATE else None, LEGACY_MEDIA_CACHE_FILE
+)
+
+# إعدادات ذاكرة معلومات الفيديو (روابط الصيغ في يوتيوب تنتهي بعد ساعات)
+PROBE_CACHE_SIZE = int(os.getenv('PROBE_CACHE_SIZE', '500'))
+PROBE_CACHE_TTL = int(os.getenv('PROBE_CACHE_TTL', '1800'))  # بالثواني
+# مفاتيح كبيرة في معلومات يوتيوب لا يحتاجها اختيار الصيغة ولا التحميل (مئات الكيلوبايت لكل فيديو)
+PROBE_DROPPED_KEYS = ('automatic_captions', 'subtitles', 'heatmap', 'description', 'tags', 'chapters')
+PROBE_THUMBNAILS_KEPT = 5  # أفضل الصور المصغرة، والباقي احتياط إذا لم توجد الأفضل
+PROBE_WORKERS = int(os.getenv('PROBE_WORKERS', '2'))
+PROBE_WAIT_TIMEOUT = float(os.getenv('PROBE_WAIT_TIMEOUT', '30'))
+
+class ProbeCache:
+    """ذاكرة مؤقتة لمعلومات الفيديو المستخرجة دون تحميل حتى لا يتكرر الاستخراج عند الضغط على الزر"""
+
+    def __init__(self, max_size=500, ttl=1800, workers=2, shared=None):
+        self.shared = shared  # حتى يستفيد العامل مما استخرجته نسخة الاستقبال مسبقاً
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (المنصة، معرف الفيديو) -> (وقت الاستخراج، المعلومات)
+        self.pending = {}  # (المنصة، معرف الفيديو) -> Future
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='probe')
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def prefetch(self, key, url):
+        """بدء استخراج المعلومات في الخلفية إن لم تكن محفوظة"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry and time.time() - entry[0] < self.ttl) or key in self.pending:
+                return
+            self.pending[key] = self.executor.submit(self._probe, key, url)
+
+    def get(self, key, timeout=PROBE_WAIT_TIMEOUT):
+        """إرجاع نسخة من المعلومات المحفوظة مع انتظار الاستخراج الجاري"""
+        with self.lock:
+            future = self.pending.get(key)
+        if future:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            if entry:
+                del self.entries[key]
+        shared = self.shared.get(self._shared_key(key)) if self.shared else None
+        with self.lock:
+            if shared:
+                self._store(key, shared['created'], shared['info'])
+                self.hits += 1
+                return copy.deepcopy(shared['info'])
+            self.misses += 1
+            return None
+
+    @staticmethod
+    def _shared_key(key):
+        return 'probe:{}:{}'.format(*key)
+
+    def _store(self, key, created, info):
+        self.entries[key] = (created, info)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def trim(info):
+        """نسخة مختصرة من المعلومات بما يكفي لـ plan_format و process_ie_result والصورة المصغرة"""
+        info = {key: value for key, value in info.items() if key not in PROBE_DROPPED_KEYS}
+        # صيغ storyboard (mhtml) لا تختار أبداً وتحمل قوائم أجزاء طويلة
+        info['formats'] = [f for f in info.get('formats') or [] if f.get('ext') != 'mhtml']
+        thumbnails = info.get('thumbnails')
+        if thumbnails:
+            # نفس ترتيب yt-dlp، فهو يكتب الأخيرة ويتراجع للتي قبلها عند الفشل
+            info['thumbnails'] = sorted(thumbnails, key=lambda t: (
+                t.get('preference') if t.get('preference') is not None else -1,
+                t.get('width') or -1, t.get('height') or -1, t.get('id') or '', t.get('url') or '',
+            ))[-PROBE_THUMBNAILS_KEPT:]
+        return info
+
+    def put(self, key, info):
+        """حفظ المعلومات مع حذف الأقدم عند امتلاء الذاكرة"""
+        info = self.trim(info)
+        created = time.time()
+        with self.lock:
+            self._store(key, created, info)
+        if self.shared:
+            # بدون المفاتيح الخاصة (مثل __post_extractor) كما يفعل yt-dlp في ملفات info.json
+            info = load_yt_dlp().YoutubeDL.sanitize_info(dict(info), remove_private_keys=True)
+            self.shared.set(self._shared_key(key), {'created': created, 'info': info}, ttl=self.ttl)
+
+    def stats(self):
+        """إحصائيات الإصابة والإخفاق"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits * 100 / total, 1) if total else 0.0,
+            }
+
+    def fetch(self, key, url):
+        """إرجاع المعلومات المحفوظة أو استخراجها الآن"""
+        info = self.get(key)
+        if info is None:
+            info = self.probe(url)
+            if info:
+                self.put(key, info)
+                info = copy.deepcopy(info)
+        return info
+
+    @staticmethod
+    def probe(url):
+        """استخراج معلومات الفيديو والصيغ دون تحميل أو اختيار صيغة"""
+        with metrics.timer('extract'), load_yt_dlp().YoutubeDL({'quiet': True, 'no_warnings': True, 'noplaylist': True}) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+        if info and info.get('_type', 'video') == 'video':
+            return info
+        return None
+
+    def _probe(self, key, url):
+        try:
+            info = self.probe(url)
+            if info:
+                self.put(key, info)
+        except Exception as e:
+            logger.warning(f"تعذر استخراج معلومات الفيديو مسبقاً: {str(e)}")
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+probe_cache = ProbeCache(PROBE_CACHE_SIZE, PROBE_CACHE_TTL, PROBE_WORKERS, state if SHARED_STATE else None)
 
 # بيانات المستخدمين
 users_data = {
-    'users': {},  # معلومات المستخدمين
-    'last_active': {},  # آخر نشاط
+    'users': {},  # المعرف -> UserRecord
     'total_downloads': 0,  # إجمالي التحميلات
 }
 
+# إعدادات قاعدة بيانات المستخدمين
+USERS_DB_FILE = os.getenv('USERS_DB_FILE', 'users_data.db')
+LEGACY_USERS_FILE = 'users_data.json'
+USERS_FLUSH_INTERVAL = float(os.getenv('USERS_FLUSH_INTERVAL', '5'))  # بالثواني، 0 = حفظ فوري
+USERS_FLUSH_BATCH = int(os.getenv('USERS_FLUSH_BATCH', '500'))
+USERS_REFRESH_INTERVAL = float(os.getenv('USERS_REFRESH_INTERVAL', '10'))  # تحديث نسخة المستخدمين من القاعدة المشتركة
+
+def to_epoch(value):
+    """تحويل وقت محفوظ (رقم أو نص ISO من الإصدارات القديمة) إلى ثوانٍ، و0 إذا لم يكن معروفاً"""
+    if not value:
+        return 0
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp())
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return int(value)
+
+def intern_text(value):
+    """مشاركة النصوص المتكررة (اللغة والحالة) بين جميع المستخدمين"""
+    return sys.intern(value) if value else value
+
+class UserRecord:
+    """بيانات مستخدم واحد في الذاكرة
+    
+    خانات ثابتة بدلاً من قاموس، والأوقات ثوانٍ صحيحة (0 = غير معروف) بدلاً من datetime.
+    last_active هنا هو المصدر الوحيد لآخر نشاط المستخدم.
+    يحفظ كمصفوفة JSON بترتيب __slots__، والخانات الجديدة تضاف في النهاية بقيمة افتراضية.
+    """
+
+    __slots__ = (
+        'user_id', 'first_name', 'last_name', 'username', 'language_code', 'downloads',
+        'youtube_downloads', 'snapchat_downloads', 'join_date', 'last_active', 'is_premium',
+        'status', 'total_interactions', 'last_interaction_type',
+    )
+
+    def __init__(self, user_id, first_name=None, last_name=None, username=None, language_code=None,
+                 downloads=0, youtube_downloads=0, snapchat_downloads=0, join_date=0, last_active=0,
+                 is_premium=False, status='active', total_interactions=0, last_interaction_type=None):
+        self.user_id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+        self.language_code = intern_text(language_code)
+        self.downloads = downloads
+        self.youtube_downloads = youtube_downloads
+        self.snapchat_downloads = snapchat_downloads
+        self.join_date = join_date
+        self.last_active = last_active
+        self.is_premium = is_premium
+        self.status = intern_text(status)
+        self.total_interactions = total_interactions
+        self.last_interaction_type = intern_text(last_interaction_type)
+
+    @classmethod
+    def from_user(cls, user, now):
+        """مستخدم جديد من بيانات تيليجرام"""
+        return cls(user.id, user.first_name, user.last_name, user.username, user.language_code,
+                   join_date=now, last_active=now)
+
+    @classmethod
+    def from_dict(cls, data):
+        """قراءة السجل المحفوظ مع تجاهل المفاتيح غير المعروفة"""
+        fields = {name: data[name] for name in cls.__slots__ if data.get(name) is not None}
+        fields['join_date'] = to_epoch(data.get('join_date'))
+        fields['last_active'] = to_epoch(data.get('last_active'))
+        return cls(**fields)
+
+    def to_row(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_json(cls, data):
+        """قراءة سجل محفوظ، ويرجع (السجل، هل هو بالصيغة القديمة)"""
+        value = json.loads(data)
+        if isinstance(value, list):
+            return cls(*value), False
+        return cls.from_dict(value), True
+
+SEARCH_RESULTS_LIMIT = int(os.getenv('SEARCH_RESULTS_LIMIT', '10'))
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', '10'))
+ACTIVE_DAYS = 7  # المستخدم نشط إذا تفاعل خلال هذه المدة
+
+class UserIndex:
+    """فهارس المستخدمين: اسم المستخدم وبادئة الاسم الأول وترتيب آخر نشاط
+    
+    البحث بالمعرف يتم مباشرة في users_data['users'] لأن مفاتيحه أرقام المستخدمين.
+    مفاتيح ترتيب النشاط (الثواني، المعرف)، وهي نفس أوقات UserRecord.
+    """
+
+    def __init__(self):
+        self.usernames = {}  # اسم المستخدم بأحرف صغيرة -> المعرف
+        self.first_names = []  # قائمة مرتبة من (الاسم الأول بأحرف صغيرة، المعرف)
+        self.indexed = {}  # المعرف -> (اسم المستخدم، الاسم الأول) المفهرسان حالياً
+        self.recency = []  # قائمة مرتبة تصاعدياً من (وقت آخر نشاط، المعرف)
+        self.recency_keys = {}  # المعرف -> مفتاحه الحالي في قائمة النشاط
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _keys(record):
+        return (
+            (record.username or '').lower(),
+            (record.first_name or '').lower(),
+        )
+
+    def add(self, user_id, record):
+        """إضافة مستخدم أو تحديث فهارسه إذا تغير اسمه"""
+        username, first_name = self._keys(record)
+        with self.lock:
+            old = self.indexed.get(user_id)
+            if old == (username, first_name):
+                return
+            if old:
+                self._remove(user_id, *old)
+            if username:
+                self.usernames[username] = user_id
+            if first_name:
+                bisect.insort(self.first_names, (first_name, user_id))
+            self.indexed[user_id] = (username, first_name)
+
+    def _remove(self, user_id, username, first_name):
+        if username and self.usernames.get(username) == user_id:
+            del self.usernames[username]
+        if first_name:
+            i = bisect.bisect_left(self.first_names, (first_name, user_id))
+            if i < len(self.first_names) and self.first_names[i] == (first_name, user_id):
+                del self.first_names[i]
+
+    def touch(self, user_id, last_active):
+        """نقل المستخدم إلى موقعه الجديد في ترتيب آخر نشاط"""
+        key = (last_active, user_id)
+        with self.lock:
+            old = self.recency_keys.get(user_id)
+            if old == key:
+                return
+            if old:
+                i = bisect.bisect_left(self.recency, old)
+                if i < len(self.recency) and self.recency[i] == old:
+                    del self.recency[i]
+            # النشاط الجديد يكون غالباً الأحدث فتكون الإضافة في نهاية القائمة
+            if not self.recency or self.recency[-1] < key:
+                self.recency.append(key)
+            else:
+                bisect.insort(self.recency, key)
+            self.recency_keys[user_id] = key
+
+    def rebuild(self, users):
+        """بناء الفهارس مرة واحدة بعد تحميل المستخدمين"""
+        with self.lock:
+            self.usernames = {}
+            self.indexed = {}
+            self.recency_keys = {}
+            names = []
+            for user_id, record in users.items():
+                username, first_name = self._keys(record)
+                if username:
+                    self.usernames[username] = user_id
+                if first_name:
+                    names.append((first_name, user_id))
+                self.indexed[user_id] = (username, first_name)
+                self.recency_keys[user_id] = (record.last_active, user_id)
+            names.sort()
+            self.first_names = names
+            self.recency = sorted(self.recency_keys.values())
+
+    def active_count(self, days=ACTIVE_DAYS):
+        """عدد المستخدمين الذين تفاعلوا خلال المدة المحددة"""
+        cutoff = time.time() - days * 86400
+        with self.lock:
+            return len(self.recency) - bisect.bisect_left(self.recency, (cutoff,))
+
+    def page(self, cursor=None, direction='next', size=USERS_PAGE_SIZE):
+        """صفحة من المستخدمين الأحدث نشاطاً أولاً، قبل المؤشر (next) أو بعده (prev)
+        
+        ترجع (المعرفات، مفتاح أول عنصر، مفتاح آخر عنصر، يوجد أحدث، يوجد أقدم، رقم أول عنصر).
+        """
+        with self.lock:
+            total = len(self.recency)
+            if cursor is None:
+                end = total
+                start = max(0, end - size)
+            elif direction == 'prev':
+                start = bisect.bisect_right(self.recency, cursor)
+                end = min(total, start + size)
+            else:
+                end = bisect.bisect_left(self.recency, cursor)
+                start = max(0, end - size)
+            keys = self.recency[start:end][::-1]
+        if not keys:
+            return [], None, None, False, False, 0
+        return [user_id for _, user_id in keys], keys[0], keys[-1], end < total, start > 0, total - end
+
+    def search(self, term, limit=SEARCH_RESULTS_LIMIT):
+        """البحث بالمعرف ثم اسم المستخدم ثم بادئة الاسم الأول"""
+        term = term.lower()
+        found = []
+        if term.isdigit() and int(term) in users_data['users']:
+            found.append(int(term))
+        with self.lock:
+            user_id = self.usernames.get(term.lstrip('@'))
+            if user_id is not None and user_id not in found:
+                found.append(user_id)
+            i = bisect.bisect_left(self.first_names, (term,))
+            while len(found) < limit and i < len(self.first_names):
+                first_name, user_id = self.first_names[i]
+                if not first_name.startswith(term):
+                    break
+                if user_id not in found:
+                    found.append(user_id)
+                i += 1
+        return found[:limit]
+
+user_index = UserIndex()
+
+class UserTotals:
+    """مجاميع تحميلات جميع المستخدمين، تحدث مع كل تحميل بدلاً من حسابها عند كل عرض"""
+
+    def __init__(self):
+        self.counts = {'youtube_downloads': 0, 'snapchat_downloads': 0}
+        self.lock = threading.Lock()
+
+    def rebuild(self, users):
+        with self.lock:
+            for name in self.counts:
+                self.counts[name] = sum(getattr(record, name) for record in users.values())
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def get(self, name):
+        return self.counts[name]
+
+user_totals = UserTotals()
+
+class HyperLogLog:
+    """تقدير عدد المستخدمين المختلفين بذاكرة ثابتة (4 KB) وخطأ تقريبي 1.6%"""
+
+    P = 12
+    M = 1 << P
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers) if registers else bytearray(self.M)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.P)
+        rest = h & ((1 << (64 - self.P)) - 1)
+        rank = (64 - self.P) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = self.M
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # تصحيح الأعداد الصغيرة بالعد الخطي
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+ACTIVITY_HOURS_KEPT = 48
+ACTIVITY_DAYS_KEPT = 35
+
+class ActivityTracker:
+    """عدادات المستخدمين النشطين لكل ساعة ولكل يوم لحساب DAU و WAU واتجاهها"""
+
+    def __init__(self):
+        self.buckets = {}  # 'h:YYYYmmddHH' أو 'd:YYYYmmdd' -> HyperLogLog
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _keys(moment):
+        return f"h:{moment.strftime('%Y%m%d%H')}", f"d:{moment.strftime('%Y%m%d')}"
+
+    def add(self, user_id, moment=None):
+        """تسجيل نشاط مستخدم في ساعة ويوم الحدث"""
+        moment = moment or datetime.now()
+        with self.lock:
+            for key in self._keys(moment):
+                sketch = self.buckets.get(key)
+                if sketch is None:
+                    sketch = self.buckets[key] = HyperLogLog()
+                    self._expire(moment)
+                if sketch.add(user_id):
+                    self.dirty.add(key)
+
+    def _expire(self, moment):
+        oldest_hour = self._keys(moment - timedelta(hours=ACTIVITY_HOURS_KEPT))[0]
+        oldest_day = self._keys(moment - timedelta(days=ACTIVITY_DAYS_KEPT))[1]
+        for key in list(self.buckets):
+            if (key.startswith('h:') and key < oldest_hour) or (key.startswith('d:') and key < oldest_day):
+                del self.buckets[key]
+
+    def _unique(self, keys):
+        merged = HyperLogLog()
+        with self.lock:
+            for key in keys:
+                if key in self.buckets:
+                    merged.merge(self.buckets[key])
+        return merged.count()
+
+    def active_hours(self, hours=24):
+        """المستخدمون المختلفون خلال آخر عدد من الساعات (نافذة منزلقة)"""
+        now = datetime.now()
+        return self._unique([self._keys(now - timedelta(hours=i))[0] for i in range(hours)])
+
+    def active_days(self, days=7):
+        """المستخدمون المختلفون خلال آخر عدد من الأيام بما فيها اليوم"""
+        now = datetime.now()
+        return self._unique([self._keys(now - timedelta(days=i))[1] for i in range(days)])
+
+    def daily_trend(self, days=7):
+        """عدد المستخدمين النشطين لكل يوم من الأيام الأخيرة (الأقدم أولاً)"""
+        now = datetime.now()
+        return [
+            ((now - timedelta(days=i)).strftime('%d-%m'), self._unique([self._keys(now - timedelta(days=i))[1]]))
+            for i in range(days - 1, -1, -1)
+        ]
+
+    def take_dirty(self):
+        """السجلات التي تغيرت منذ آخر حفظ"""
+        with self.lock:
+            keys, self.dirty = self.dirty, set()
+            return [(key, bytes(self.buckets[key].registers)) for key in keys if key in self.buckets]
+
+    def restore(self, rows):
+        """إعادة السجلات التي فشل حفظها للحفظ التالي، فالسجل الممتلئ لا يتغير مرة أخرى"""
+        with self.lock:
+            self.dirty.update(key for key, _ in rows)
+
+    def load(self, rows):
+        with self.lock:
+            self.buckets = {key: HyperLogLog(registers) for key, registers in rows}
+            self._expire(datetime.now())
+
+activity = ActivityTracker()
+
+class UserChanges:
+    """تغييرات المستخدمين التي لم تحفظ بعد، كحقول منفصلة بدلاً من السجل كاملاً
+    
+    كل نسخة من البوت تحمل نسختها الخاصة من المستخدمين، لذلك لا تكتب السجل كاملاً:
+    العدادات تحفظ كزيادات، وآخر نشاط كأكبر قيمة، وتاريخ الانضمام فقط إذا لم يكن محفوظاً،
+    وباقي الحقول كقيم جديدة. بذلك لا تلغي كتابة نسخة ما كتبته نسخة أخرى (BOT_ROLE).
+    """
+
+    COUNTERS = ('downloads', 'youtube_downloads', 'snapchat_downloads', 'total_interactions')
+
+    def __init__(self):
+        self.pending = {}  # المعرف -> {الحقل: القيمة الجديدة أو الزيادة}
+        self.total_downloads = 0  # زيادة العداد العام منذ آخر حفظ
+        self.lock = threading.Lock()
+
+    def set(self, user_id, **fields):
+        with self.lock:
+            self.pending.setdefault(user_id, {}).update(fields)
+
+    def add(self, user_id, field, value=1):
+        with self.lock:
+            changes = self.pending.setdefault(user_id, {})
+            changes[field] = changes.get(field, 0) + value
+
+    def add_total(self, value=1):
+        with self.lock:
+            self.total_downloads += value
+
+    def created(self, record):
+        """تسجيل جميع حقول مستخدم جديد"""
+        self.set(record.user_id, **{
+            name: getattr(record, name) for name in UserRecord.__slots__
+            if name not in self.COUNTERS and name != 'user_id'
+        })
+
+    def take(self, user_ids):
+        """سحب تغييرات المستخدمين المحددين وزيادة العداد العام"""
+        with self.lock:
+            changes = {uid: self.pending.pop(uid) for uid in user_ids if uid in self.pending}
+            total, self.total_downloads = self.total_downloads, 0
+        return changes, total
+
+    def restore(self, changes, total):
+        """إعادة تغييرات فشل حفظها دون إلغاء ما سجل بعدها"""
+        with self.lock:
+            self.total_downloads += total
+            for uid, fields in changes.items():
+                current = self.pending.setdefault(uid, {})
+                for field, value in fields.items():
+                    if field in self.COUNTERS:
+                        current[field] = current.get(field, 0) + value
+                    else:
+                        current.setdefault(field, value)
+
+user_changes = UserChanges()
+
+STATUS_SLOT = UserRecord.__slots__.index('status')
+
+class UserStore:
+    """تخزين بيانات المستخدمين في SQLite بحيث يكتب كل تحديث سجلاً واحداً فقط"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """فتح قاعدة البيانات وإنشاء الجداول"""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(users)')]
+            if 'updated' not in columns:
+                # وقت آخر تعديل حتى تقرأ كل نسخة ما غيرته النسخ الأخرى فقط
+                self.conn.execute('ALTER TABLE users ADD COLUMN updated REAL NOT NULL DEFAULT 0')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS users_updated ON users (updated)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS last_active (user_id INTEGER PRIMARY KEY, ts TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS activity (bucket TEXT PRIMARY KEY, registers BLOB NOT NULL)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS broadcasts ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, admin_chat_id INTEGER, '
+                'status_message_id INTEGER, cursor INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, '
+                'sent INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, '
+                "blocked INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'running')"
+            )
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM users LIMIT 1').fetchone() is None
+
+    @staticmethod
+    def _field_update(changes):
+        """تعبير json_set يطبق تغييرات الحقول على السجل المحفوظ في القاعدة"""
+        parts, params = [], []
+        for field, value in changes.items():
+            path = f"'$[{UserRecord.__slots__.index(field)}]'"
+            if field in UserChanges.COUNTERS:
+                expression = f'COALESCE(json_extract(data, {path}), 0) + ?'
+            elif field == 'last_active':
+                expression = f'MAX(COALESCE(json_extract(data, {path}), 0), ?)'
+            elif field == 'join_date':
+                expression = f'COALESCE(NULLIF(json_extract(data, {path}), 0), ?)'
+            elif isinstance(value, bool):
+                expression = "json(CASE WHEN ? THEN 'true' ELSE 'false' END)"
+            else:
+                expression = '?'
+            parts.append(f'{path}, {expression}')
+            params.append(value)
+        return 'json_set(data, ' + ', '.join(parts) + ')', params
+
+    def save_changes(self, changes, total_downloads, activity_rows=()):
+        """حفظ تغييرات دفعة من المستخدمين ونشاطهم والعداد العام في معاملة واحدة
+        
+        لا يكتب السجل كاملاً أبداً: المستخدم غير الموجود يضاف بالقيم الافتراضية ثم تطبق تغييراته،
+        وسجلات النشاط تدمج مع المحفوظ.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            for bucket, registers in activity_rows:
+                row = self.conn.execute('SELECT registers FROM activity WHERE bucket = ?', (bucket,)).fetchone()
+                if row:
+                    merged = HyperLogLog(registers)
+                    merged.merge(HyperLogLog(row[0]))
+                    registers = bytes(merged.registers)
+                self.conn.execute('INSERT OR REPLACE INTO activity (bucket, registers) VALUES (?, ?)', (bucket, registers))
+            for uid, fields in changes.items():
+                self.conn.execute(
+                    'INSERT OR IGNORE INTO users (user_id, data) VALUES (?, ?)',
+                    (uid, json.dumps(UserRecord(uid).to_row()))
+                )
+                expression, params = self._field_update(fields)
+                if SHARED_STATE:
+                    # وقت التعديل يحتاجه refresh_users فقط، وتحديث فهرسه يضاعف الكتابة تقريباً
+                    expression, params = f'{expression}, updated = ?', params + [now]
+                self.conn.execute(f'UPDATE users SET data = {expression} WHERE user_id = ?', params + [uid])
+            self.conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('total_downloads', 0)")
+            self.conn.execute(
+                "UPDATE counters SET value = value + ? WHERE name = 'total_downloads'", (total_downloads,)
+            )
+
+    def save_all(self, data):
+        """إعادة كتابة جميع البيانات في معاملة واحدة"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)',
+                ((uid, json.dumps(record.to_row(), ensure_ascii=False)) for uid, record in data['users'].items())
+            )
+            # آخر نشاط أصبح جزءاً من سجل المستخدم
+            self.conn.execute('DELETE FROM last_active')
+            self.conn.execute(
+                "INSERT OR REPLACE INTO counters (name, value) VALUES ('total_downloads', ?)",
+                (data['total_downloads'],)
+            )
+
+    def changed_since(self, since):
+        """المستخدمون الذين عدلتهم أي نسخة منذ الوقت المحدد"""
+        with self.lock:
+            rows = self.conn.execute('SELECT user_id, data FROM users WHERE updated >= ?', (since,)).fetchall()
+        return [(uid, UserRecord.from_json(data)[0]) for uid, data in rows]
+
+    def broadcast_targets(self, cursor, limit):
+        """معرفات المستخدمين بعد الموضع الحالي مع تجاهل من حظر البوت"""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT user_id FROM users WHERE user_id > ? AND json_extract(data, '$[{STATUS_SLOT}]') IS NOT 'blocked' "
+                'ORDER BY user_id LIMIT ?',
+                (cursor, limit)
+            ).fetchall()
+        return [uid for uid, in rows]
+
+    def count_targets(self):
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT COUNT(*) FROM users WHERE json_extract(data, '$[{STATUS_SLOT}]') IS NOT 'blocked'"
+            ).fetchone()[0]
+
+    def create_broadcast(self, text, admin_chat_id, status_message_id, total):
+        """تسجيل رسالة جماعية جديدة وإرجاع معرفها"""
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                'INSERT INTO broadcasts (text, admin_chat_id, status_message_id, total) VALUES (?, ?, ?, ?)',
+                (text, admin_chat_id, status_message_id, total)
+            )
+            return cursor.lastrowid
+
+    def update_broadcast(self, broadcast):
+        """حفظ موضع الإرسال والعدادات لاستكمالها بعد إعادة التشغيل"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, status = ? WHERE id = ?',
+                (broadcast['cursor'], broadcast['sent'], broadcast['failed'],
+                 broadcast['blocked'], broadcast['status'], broadcast['id'])
+            )
+
+    def running_broadcasts(self):
+        """الرسائل الجماعية التي لم تكتمل"""
+        with self.lock:
+            self.conn.row_factory = sqlite3.Row
+            try:
+                rows = self.conn.execute("SELECT * FROM broadcasts WHERE status = 'running'").fetchall()
+            finally:
+                self.conn.row_factory = None
+        return [dict(row) for row in rows]
+
+    def load(self):
+        """قراءة جميع البيانات من القاعدة
+        
+        ترجع (المستخدمين، إجمالي التحميلات، هل توجد بيانات بالصيغة القديمة يجب إعادة حفظها).
+        """
+        users = {}
+        legacy = False
+        with self.lock:
+            for uid, data in self.conn.execute('SELECT user_id, data FROM users'):
+                users[uid], old_format = UserRecord.from_json(data)
+                legacy = legacy or old_format
+            legacy_last_active = self.conn.execute('SELECT user_id, ts FROM last_active WHERE ts IS NOT NULL').fetchall()
+            row = self.conn.execute("SELECT value FROM counters WHERE name = 'total_downloads'").fetchone()
+        legacy = merge_last_active(users, legacy_last_active) or legacy
+        return users, row[0] if row else 0, legacy
+
+    def load_activity(self):
+        with self.lock:
+            return self.conn.execute('SELECT bucket, registers FROM activity').fetchall()
+
+user_store = UserStore(USERS_DB_FILE)
+
 def save_users_data():
-    """حفظ بيانات المستخدمين في ملف"""
-    data_file = Path('users_data.json')
-    # تحويل التواريخ إلى نص قبل الحفظ
-    data_to_save = {
-        'users': {
-            str(uid): {
-                **user_data,
-                'join_date': user_data['join_date'].isoformat() if isinstance(user_data.get('join_date'), datetime) else None,
-                'last_active': user_data['last_active'].isoformat() if isinstance(user_data.get('last_active'), datetime) else None
-            }
-            for uid, user_data in users_data['users'].items()
-        },
-        'last_active': {
-            str(uid): time.isoformat() if isinstance(time, datetime) else None
-            for uid, time in users_data['last_active'].items()
-        },
-        'total_downloads': users_data['total_downloads']
-    }
-    with open(data_file, 'w', encoding='utf-8') as f:
-        json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+    """حفظ جميع بيانات المستخدمين"""
+    user_store.save_all(users_data)
+
+class WriteBehind:
+    """تجميع تحديثات المستخدمين في الذاكرة وحفظها على دفعات"""
+
+    def __init__(self, flush_func, interval=5.0, batch_size=500):
+        self.flush_func = flush_func
+        self.interval = interval  # أقصى مدة قد تفقد فيها البيانات عند التوقف المفاجئ
+        self.batch_size = batch_size
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def start(self):
+        """تشغيل خيط الحفظ الدوري"""
+        if self.interval > 0:
+            threading.Thread(target=self._run, name='users-flusher', daemon=True).start()
+
+    def mark(self, key):
+        """تعليم عنصر كمعدّل ليُحفظ في الدفعة التالية"""
+        with self.lock:
+            self.dirty.add(key)
+            full = len(self.dirty) >= self.batch_size
+        if self.interval <= 0:
+            self.flush()
+        elif full:
+            self.wakeup.set()
+
+    def flush(self):
+        """حفظ جميع العناصر المعدّلة"""
+        with self.flush_lock:
+            with self.lock:
+                keys, self.dirty = self.dirty, set()
+            if not keys:
+                return
+            try:
+                self.flush_func(keys)
+            except Exception as e:
+                logger.error(f"خطأ في حفظ بيانات المستخدمين: {str(e)}")
+                with self.lock:
+                    self.dirty |= keys
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+def flush_user_records(user_ids):
+    """كتابة تغييرات المستخدمين المعدّلين إلى قاعدة البيانات"""
+    changes, total = user_changes.take(user_ids)
+    activity_rows = activity.take_dirty()
+    try:
+        user_store.save_changes(changes, total, activity_rows)
+    except Exception:
+        user_changes.restore(changes, total)
+        activity.restore(activity_rows)
+        raise
+
+users_writer = WriteBehind(flush_user_records, USERS_FLUSH_INTERVAL, USERS_FLUSH_BATCH)
+
+def save_user_record(user_id):
+    """حفظ بيانات مستخدم واحد في الدفعة التالية بدلاً من إعادة كتابة الملف كاملاً"""
+    users_writer.mark(user_id)
+
+users_refresh = {'since': 0.0, 'checked': 0.0}
+users_refresh_lock = threading.Lock()
+
+def refresh_users():
+    """قراءة المستخدمين الذين عدلتهم النسخ الأخرى قبل عرض الإحصائيات والبحث (SHARED_STATE فقط)"""
+    if not SHARED_STATE:
+        return
+    with users_refresh_lock:
+        now = time.time()
+        if now - users_refresh['checked'] < USERS_REFRESH_INTERVAL:
+            return
+        # هامش للمعاملات التي بدأت قبل آخر تحديث واكتملت بعده
+        changed = user_store.changed_since(users_refresh['since'] - 5)
+        users_refresh['since'] = users_refresh['checked'] = now
+        for uid, record in changed:
+            old = users_data['users'].get(uid)
+            for name in ('youtube_downloads', 'snapchat_downloads'):
+                user_totals.inc(name, getattr(record, name) - (getattr(old, name) if old else 0))
+            users_data['users'][uid] = record
+            user_index.add(uid, record)
+            user_index.touch(uid, record.last_active)
+        users_data['total_downloads'] = state.incr('total_downloads', 0, initial=users_data['total_downloads'])
+
+def merge_last_active(users, last_active):
+    """دمج أوقات النشاط المحفوظة منفصلة في الإصدارات القديمة، ويرجع True إذا وجدت"""
+    merged = False
+    for uid, value in last_active:
+        record = users.get(int(uid))
+        if record is not None and value:
+            record.last_active = max(record.last_active, to_epoch(value))
+            merged = True
+    return merged
 
 def load_users_data():
-    """تحميل بيانات المستخدمين من الملف"""
-    data_file = Path('users_data.json')
-    if data_file.exists():
+    """تحميل بيانات المستخدمين من قاعدة البيانات"""
+    user_store.open()
+    
+    # ترحيل البيانات القديمة من ملف JSON مرة واحدة
+    data_file = Path(LEGACY_USERS_FILE)
+    if user_store.is_empty() and data_file.exists():
         with open(data_file, 'r', encoding='utf-8') as f:
             data = json.load(f)
-            # تحويل النصوص إلى تواريخ
-            users_data['users'] = {
-                int(uid): {
-                    **user_data,
-                    'join_date': datetime.fromisoformat(user_data['join_date']) if user_data.get('join_date') else None,
-                    'last_active': datetime.fromisoformat(user_data['last_active']) if user_data.get('last_active') else None
-                }
-                for uid, user_data in data['users'].items()
-            }
-            users_data['last_active'] = {
-                int(uid): datetime.fromisoformat(time) if time else None
-                for uid, time in data['last_active'].items()
-            }
-            users_data['total_downloads'] = data['total_downloads']
+        users_data['users'] = {int(uid): UserRecord.from_dict(user_data) for uid, user_data in data['users'].items()}
+        merge_last_active(users_data['users'], data['last_active'].items())
+        users_data['total_downloads'] = data['total_downloads']
+        save_users_data()
+        user_index.rebuild(users_data['users'])
+        user_totals.rebuild(users_data['users'])
+        logger.info(f"تم ترحيل {len(users_data['users'])} مستخدم من {LEGACY_USERS_FILE}")
+        return
+    
+    users_refresh['since'] = users_refresh['checked'] = time.time()
+    users_data['users'], users_data['total_downloads'], legacy = user_store.load()
+    if legacy:
+        # إعادة الحفظ مرة واحدة بالصيغة الجديدة وحذف جدول آخر نشاط القديم
+        save_users_data()
+        logger.info(f"تم تحويل {len(users_data['users'])} مستخدم إلى الصيغة الجديدة")
+    user_index.rebuild(users_data['users'])
+    user_totals.rebuild(users_data['users'])
+    activity.load(user_store.load_activity())
 
 def update_user_stats(user_id, action='login'):
     """تحديث إحصائيات المستخدم"""
@@ -89,58 +2236,57 @@ def update_user_stats(user_id, action='login'):
             user_id = user.id
             
             # تحديث أو إنشاء بيانات المستخدم
-            if user_id not in users_data['users']:
-                users_data['users'][user_id] = {
-                    'user_id': user_id,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'username': user.username,
-                    'language_code': user.language_code,
-                    'downloads': 0,
-                    'youtube_downloads': 0,
-                    'snapchat_downloads': 0,
-                    'join_date': datetime.now(),
-                    'last_active': datetime.now(),
-                    'is_premium': False,
-                    'status': 'active',
-                    'total_interactions': 0,
-                    'last_interaction_type': None,
-                }
+            now = int(time.time())
+            record = users_data['users'].get(user_id)
+            if record is None:
+                record = users_data['users'][user_id] = UserRecord.from_user(user, now)
+                user_changes.created(record)
                 logger.info(f"مستخدم جديد: {user.first_name} (ID: {user_id})")
             
             # تحديث البيانات الموجودة
-            user_data = users_data['users'][user_id]
-            user_data['last_active'] = datetime.now()
-            
-            # التأكد من وجود جميع المفاتيح المطلوبة
-            if 'total_interactions' not in user_data:
-                user_data['total_interactions'] = 0
-            if 'status' not in user_data:
-                user_data['status'] = 'active'
-            if 'last_interaction_type' not in user_data:
-                user_data['last_interaction_type'] = None
-            
-            user_data['total_interactions'] += 1
+            record.last_active = now
+            record.first_name = user.first_name
+            record.username = user.username
+            user_index.add(user_id, record)
+            user_index.touch(user_id, now)
+            record.total_interactions += 1
+            user_changes.set(user_id, first_name=user.first_name, username=user.username, last_active=now)
+            user_changes.add(user_id, 'total_interactions')
+        
+        activity.add(user_id)
+        # نسخة العمال قد لا تعرف المستخدم، لكن تغييراته تحفظ في القاعدة المشتركة
+        record = users_data['users'].get(user_id)
             
         if action == 'login':
-            users_data['last_active'][user_id] = datetime.now()
-            if user_id in users_data['users']:
-                users_data['users'][user_id]['status'] = 'active'
+            now = int(time.time())
+            user_changes.set(user_id, status='active', last_active=now)
+            if record is not None:
+                record.status = 'active'
+                record.last_active = now
+                user_index.touch(user_id, now)
         elif action == 'download':
-            users_data['total_downloads'] += 1
-            if user_id in users_data['users']:
-                users_data['users'][user_id]['downloads'] += 1
-                users_data['users'][user_id]['last_interaction_type'] = 'download'
-            users_data['last_active'][user_id] = datetime.now()
-        elif action == 'youtube':
-            if user_id in users_data['users']:
-                users_data['users'][user_id]['youtube_downloads'] += 1
-        elif action == 'snapchat':
-            if user_id in users_data['users']:
-                users_data['users'][user_id]['snapchat_downloads'] += 1
-        
-        # حفظ البيانات بعد كل تحديث
-        save_users_data()
+            now = int(time.time())
+            if SHARED_STATE:
+                users_data['total_downloads'] = state.incr('total_downloads', initial=users_data['total_downloads'])
+            else:
+                users_data['total_downloads'] += 1
+            user_changes.add_total()
+            user_changes.add(user_id, 'downloads')
+            user_changes.set(user_id, last_interaction_type='download', last_active=now)
+            if record is not None:
+                record.downloads += 1
+                record.last_interaction_type = 'download'
+                record.last_active = now
+                user_index.touch(user_id, now)
+        elif action in ('youtube', 'snapchat'):
+            field = f'{action}_downloads'
+            user_changes.add(user_id, field)
+            user_totals.inc(field)
+            if record is not None:
+                setattr(record, field, getattr(record, field) + 1)
+        
+        # حفظ سجل المستخدم فقط بعد كل تحديث
+        save_user_record(user_id)
         
     except Exception as e:
         logger.error(f"خطأ في تحديث بيانات المستخدم: {str(e)}")
@@ -148,39 +2294,230 @@ def update_user_stats(user_id, action='login'):
         if isinstance(user_id, Update):
             user = user_id.message.from_user
             user_id = user.id
-            users_data['users'][user_id] = {
-                'user_id': user_id,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'username': user.username,
-                'language_code': user.language_code,
-                'downloads': 0,
-                'youtube_downloads': 0,
-                'snapchat_downloads': 0,
-                'join_date': datetime.now(),
-                'last_active': datetime.now(),
-                'is_premium': False,
-                'status': 'active',
-                'total_interactions': 1,
-                'last_interaction_type': None,
-            }
-            save_users_data()
+            record = users_data['users'][user_id] = UserRecord.from_user(user, int(time.time()))
+            record.total_interactions = 1
+            user_changes.created(record)
+            user_changes.add(user_id, 'total_interactions')
+            user_index.add(user_id, record)
+            user_index.touch(user_id, record.last_active)
+            save_user_record(user_id)
+
+# إعدادات الرسائل الجماعية
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # رسالة في الثانية (حد تيليجرام ~30)
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_PROMPT_TTL = 600  # مدة انتظار نص الرسالة الجماعية بعد الضغط على الزر
+BROADCAST_LEASE = 600  # تجدد مع كل دفعة، وبعد انتهائها يمكن لنسخة أخرى استكمال الرسالة
+BROADCAST_WATCHDOG_INTERVAL = BROADCAST_LEASE / 2  # فحص الرسائل التي انتهت مهلة نسختها
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+
+class Broadcaster:
+    """إرسال الرسائل الجماعية بالتوازي ضمن حدود تيليجرام مع إمكانية الاستكمال"""
+
+    def __init__(self, store, rate=25, workers=8):
+        self.store = store
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.paused_until = 0
+        self.running = set()  # الرسائل التي ترسلها هذه النسخة
+        self.lock = threading.Lock()
+
+    def start(self, bot, admin_chat_id, text):
+        """بدء رسالة جماعية جديدة في الخلفية"""
+        # المستخدمون من القاعدة المشتركة حتى يشمل الإرسال من ظهر أولاً في نسخ أخرى
+        users_writer.flush()
+        total = self.store.count_targets()
+        status_message = bot.send_message(
+            chat_id=admin_chat_id,
+            text=f"📢 جاري إرسال الرسالة إلى {total} مستخدم..."
+        )
+        broadcast_id = self.store.create_broadcast(text, admin_chat_id, status_message.message_id, total)
+        broadcast = {
+            'id': broadcast_id, 'text': text, 'admin_chat_id': admin_chat_id,
+            'status_message_id': status_message.message_id, 'cursor': 0, 'total': total,
+            'sent': 0, 'failed': 0, 'blocked': 0, 'status': 'running',
+        }
+        self._spawn(bot, broadcast)
+
+    def resume(self, bot):
+        """استكمال الرسائل الجماعية التي توقفت بسبب إعادة التشغيل"""
+        for broadcast in self.store.running_broadcasts():
+            if not SHARED_STATE:
+                # لا توجد نسخة أخرى، فالمهلة المحفوظة تخص التشغيل السابق الذي توقف
+                state.delete(f"broadcast:{broadcast['id']}")
+            if self._spawn(bot, broadcast):
+                logger.info(f"استكمال الرسالة الجماعية {broadcast['id']} من المستخدم {broadcast['cursor']}")
+
+    def start_watchdog(self, bot, interval=BROADCAST_WATCHDOG_INTERVAL):
+        """استكمال الرسائل التي انتهت مهلة النسخة التي كانت ترسلها"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    for broadcast in self.store.running_broadcasts():
+                        if self._spawn(bot, broadcast):
+                            logger.info(f"استكمال الرسالة الجماعية {broadcast['id']} بعد انتهاء مهلة نسخة أخرى")
+                except Exception as e:
+                    logger.error(f"خطأ في فحص الرسائل الجماعية: {str(e)}")
+        threading.Thread(target=run, name='broadcast-watchdog', daemon=True).start()
+
+    def _spawn(self, bot, broadcast):
+        """بدء الإرسال إذا لم تكن رسالة أخرى ترسلها، وإرجاع True عند البدء"""
+        with self.lock:
+            if broadcast['id'] in self.running:
+                return False
+            # نسخة واحدة فقط ترسل كل رسالة جماعية
+            if not state.add(f"broadcast:{broadcast['id']}", INSTANCE_ID, ttl=BROADCAST_LEASE):
+                return False
+            self.running.add(broadcast['id'])
+        if async_core.running:
+            async_core.submit(self._run_async(bot, broadcast))
+            return True
+        threading.Thread(
+            target=self._run, args=(bot, broadcast),
+            name=f"broadcast-{broadcast['id']}", daemon=True
+        ).start()
+        return True
+
+    def _send_one(self, bot, uid, text):
+        """إرسال الرسالة لمستخدم واحد وإرجاع النتيجة"""
+        for _ in range(3):
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.bucket.acquire()
+            try:
+                bot.send_message(chat_id=uid, text=text, parse_mode='Markdown')
+                return 'sent'
+            except RetryAfter as e:
+                # إيقاف جميع العمال مؤقتاً حسب طلب تيليجرام
+                with self.lock:
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            except Unauthorized:
+                return 'blocked'
+            except TelegramError as e:
+                logger.error(f"Error sending broadcast to {uid}: {str(e)}")
+                return 'failed'
+        return 'failed'
+
+    async def _send_one_async(self, bot, uid, text):
+        """نسخة asyncio من _send_one تنتظر دون حجز خيط"""
+        for _ in range(3):
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while not self.bucket.try_acquire():
+                await asyncio.sleep(1 / self.bucket.rate)
+            try:
+                await async_core.call(bot.send_message, chat_id=uid, text=text, parse_mode='Markdown')
+                return 'sent'
+            except RetryAfter as e:
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            except Unauthorized:
+                return 'blocked'
+            except TelegramError as e:
+                logger.error(f"Error sending broadcast to {uid}: {str(e)}")
+                return 'failed'
+        return 'failed'
+
+    def _batches(self, broadcast):
+        """دفعات المستخدمين بعد الموضع الحالي، تقرأ من القاعدة دفعة بدفعة"""
+        cursor = broadcast['cursor']
+        while True:
+            batch = self.store.broadcast_targets(cursor, self.workers * 4)
+            if not batch:
+                return
+            yield batch
+            cursor = batch[-1]
+
+    def _record_batch(self, bot, broadcast, batch, results):
+        """تحديث العدادات وحفظ الموضع بعد اكتمال الدفعة"""
+        for uid, result in zip(batch, results):
+            broadcast[result] += 1
+            if result == 'blocked':
+                # تعليم المستخدم في القاعدة حتى تتجاهله الرسائل القادمة من جميع النسخ
+                user_changes.set(uid, status='blocked')
+                save_user_record(uid)
+                record = users_data['users'].get(uid)
+                if record is not None:
+                    record.status = 'blocked'
+        
+        broadcast['cursor'] = batch[-1]
+        self.store.update_broadcast(broadcast)
+        state.set(f"broadcast:{broadcast['id']}", INSTANCE_ID, ttl=BROADCAST_LEASE)
+        
+        if time.monotonic() - broadcast.get('last_progress', 0) >= BROADCAST_PROGRESS_INTERVAL:
+            broadcast['last_progress'] = time.monotonic()
+            self._report(bot, broadcast, "📢 جاري إرسال الرسالة للمستخدمين...")
+
+    def _finish(self, bot, broadcast):
+        broadcast['status'] = 'done'
+        self.store.update_broadcast(broadcast)
+        state.delete(f"broadcast:{broadcast['id']}")
+        self._report(bot, broadcast, "✅ تم إرسال الرسالة بنجاح!")
+
+    def _run(self, bot, broadcast):
+        broadcast['last_progress'] = time.monotonic()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for batch in self._batches(broadcast):
+                    results = list(executor.map(lambda uid: self._send_one(bot, uid, broadcast['text']), batch))
+                    self._record_batch(bot, broadcast, batch, results)
+            self._finish(bot, broadcast)
+        finally:
+            # عند التوقف بخطأ يستكملها الفحص الدوري بعد انتهاء المهلة
+            self.running.discard(broadcast['id'])
+
+    async def _run_async(self, bot, broadcast):
+        broadcast['last_progress'] = time.monotonic()
+        semaphore = asyncio.Semaphore(self.workers)
+        
+        async def send(uid):
+            async with semaphore:
+                return await self._send_one_async(bot, uid, broadcast['text'])
+        
+        try:
+            for batch in self._batches(broadcast):
+                results = await asyncio.gather(*(send(uid) for uid in batch))
+                await async_core.call(self._record_batch, bot, broadcast, batch, results)
+            await async_core.call(self._finish, bot, broadcast)
+        finally:
+            self.running.discard(broadcast['id'])
+
+    @staticmethod
+    def _report(bot, broadcast, title):
+        """تحديث رسالة التقدم لدى المشرف"""
+        done = broadcast['sent'] + broadcast['failed'] + broadcast['blocked']
+        try:
+            bot.edit_message_text(
+                chat_id=broadcast['admin_chat_id'],
+                message_id=broadcast['status_message_id'],
+                text=(
+                    f"{title}\n\n"
+                    f"📤 تم الإرسال: {broadcast['sent']}\n"
+                    f"❌ فشل الإرسال: {broadcast['failed']}\n"
+                    f"🚫 حظروا البوت: {broadcast['blocked']}\n"
+                    f"📊 التقدم: {done}/{broadcast['total']}"
+                )
+            )
+        except TelegramError as e:
+            logger.warning(f"تعذر تحديث تقدم الرسالة الجماعية: {str(e)}")
 
-def format_time_ago(time):
-    """تنسيق الوقت المنقضي"""
-    now = datetime.now()
-    diff = now - time
+broadcaster = Broadcaster(user_store, BROADCAST_RATE, BROADCAST_WORKERS)
+
+def format_time_ago(timestamp):
+    """تنسيق الوقت المنقضي منذ وقت بالثواني"""
+    diff = time.time() - timestamp
     
-    if diff.total_seconds() < 60:
+    if diff < 60:
         return "منذ لحظات"
-    elif diff.total_seconds() < 3600:
-        minutes = int(diff.total_seconds() / 60)
+    elif diff < 3600:
+        minutes = int(diff / 60)
         return f"منذ {minutes} دقيقة"
-    elif diff.total_seconds() < 86400:
-        hours = int(diff.total_seconds() / 3600)
+    elif diff < 86400:
+        hours = int(diff / 3600)
         return f"منذ {hours} ساعة"
     else:
-        days = int(diff.total_seconds() / 86400)
+        days = int(diff / 86400)
         return f"منذ {days} يوم"
 
 def show_dashboard(update: Update, context: CallbackContext):
@@ -220,9 +2557,10 @@ def handle_message(update: Update, context: CallbackContext):
         show_dashboard(update, context)
         return
 
-    # معالجة الروابط
-    if is_youtube_url(text) or is_snapchat_url(text):
-        handle_url(update, context)
+    # معالجة الروابط (يتم تحليل الرابط مرة واحدة فقط)
+    link = parse_media_url(text)
+    if link:
+        handle_url(update, context, link)
         return
 
     # معالجة أزرار لوحة التحكم
@@ -231,26 +2569,29 @@ def handle_message(update: Update, context: CallbackContext):
             update.message.reply_text("⚠️ عذراً، هذه الميزة متاحة فقط للمشرف.")
             return
             
+        refresh_users()
         total_users = len(users_data['users'])
-        active_today = sum(1 for last_active in users_data['last_active'].values()
-                          if (datetime.now() - last_active).total_seconds() < 86400)
+        active_today = activity.active_hours(24)
         total_downloads = users_data['total_downloads']
         
+        # أحدث المستخدمين نشاطاً من فهرس آخر نشاط
         user_list = []
-        for uid, user_info in users_data['users'].items():
-            last_active = users_data['last_active'].get(int(uid), datetime.min)
-            time_diff = datetime.now() - last_active
+        for uid in user_index.page(size=10)[0]:
+            record = users_data['users'].get(uid)
+            if record is None:
+                continue
+            time_diff = time.time() - record.last_active
             
-            if time_diff.total_seconds() < 3600:
+            if time_diff < 3600:
                 status = "🟢"
-            elif time_diff.total_seconds() < 86400:
+            elif time_diff < 86400:
                 status = "🟡"
             else:
                 status = "⚪️"
             
-            username = user_info.get('username') or user_info.get('first_name') or uid
-            downloads = user_info.get('downloads', 0)
-            last_seen = format_time_ago(last_active)
+            username = record.username or record.first_name or uid
+            downloads = record.downloads
+            last_seen = format_time_ago(record.last_active) if record.last_active else "غير متوفر"
             
             user_list.append(
                 f"{status} *المستخدم*: {username}\n"
@@ -275,7 +2616,8 @@ def handle_message(update: Update, context: CallbackContext):
             update.message.reply_text("⚠️ عذراً، هذه الميزة متاحة فقط للمشرف.")
             return
             
-        context.user_data['waiting_for_broadcast'] = True
+        # الحالة في التخزين المشترك لأن الرسالة التالية قد تصل إلى نسخة أخرى من البوت
+        state.set(f'flag:{user.id}:waiting_for_broadcast', True, ttl=BROADCAST_PROMPT_TTL)
         update.message.reply_text(
             "📢 *إرسال رسالة جماعية*\n\n"
             "أرسل الرسالة التي تريد إرسالها لجميع المستخدمين.",
@@ -284,31 +2626,8 @@ def handle_message(update: Update, context: CallbackContext):
         return
 
     # التحقق من انتظار رسالة جماعية
-    if str(user.id) == ADMIN_ID and context.user_data.get('waiting_for_broadcast'):
-        context.user_data['waiting_for_broadcast'] = False
-        broadcast_message = text
-        sent_count = 0
-        failed_count = 0
-        
-        update.message.reply_text("جاري إرسال الرسالة للمستخدمين...")
-        
-        for uid in users_data['users']:
-            try:
-                context.bot.send_message(
-                    chat_id=uid,
-                    text=broadcast_message,
-                    parse_mode='Markdown'
-                )
-                sent_count += 1
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"Error sending broadcast to {uid}: {str(e)}")
-        
-        update.message.reply_text(
-            f"✅ تم إرسال الرسالة بنجاح!\n\n"
-            f"📤 تم الإرسال: {sent_count}\n"
-            f"❌ فشل الإرسال: {failed_count}"
-        )
+    if str(user.id) == ADMIN_ID and state.pop(f'flag:{user.id}:waiting_for_broadcast'):
+        broadcaster.start(context.bot, update.message.chat_id, text)
         return
 
     keyboard = [
@@ -330,42 +2649,37 @@ def handle_message(update: Update, context: CallbackContext):
     if user.id not in users_data['users']:
         update.message.reply_text(message, reply_markup=reply_markup)
 
-def handle_url(update: Update, context: CallbackContext):
+def handle_url(update: Update, context: CallbackContext, link=None):
     """معالجة الروابط المرسلة للبوت"""
     if not update.message:
         return
 
-    url = update.message.text.strip()
+    link = link or parse_media_url(update.message.text.strip())
     user_id = update.message.from_user.id
-    chat_id = update.message.chat_id
+    if link is None:
+        return
+    
+    # رفض الطلب قبل استخراج المعلومات أو التحميل إذا تجاوز الحدود
+    rejection = admission_message(user_id, update.message.chat_id)
+    if rejection:
+        update.message.reply_text(rejection)
+        return
 
     try:
-        if is_snapchat_url(url):
+        if link.platform == 'snapchat':
             status_message = update.message.reply_text("⏳ جاري تحميل الفيديو من سناب شات...")
-            try:
-                filename, title = download_snapchat(url, user_id)
-                if filename and os.path.exists(filename):
-                    # إرسال الفيديو
-                    with open(filename, 'rb') as video_file:
-                        update.message.reply_video(
-                            video=video_file,
-                            caption=f"✅ تم التحميل بنجاح!\n🎥 {title}",
-                            supports_streaming=True
-                        )
-                    status_message.delete()
-                    # حذف الملف بعد الإرسال
-                    os.remove(filename)
-                else:
-                    status_message.edit_text("❌ عذراً، فشل تحميل الفيديو. الرجاء المحاولة مرة أخرى.")
-            except Exception as e:
-                logger.error(f"Error downloading Snapchat video: {str(e)}")
-                status_message.edit_text("❌ عذراً، حدث خطأ أثناء تحميل الفيديو. الرجاء المحاولة مرة أخرى.")
+            submit_download(status_message, user_id, download_snapchat_job, status_message, user_id, link.url)
         
-        elif is_youtube_url(url):
+        elif link.platform == 'youtube':
+            # استخراج معلومات الفيديو مسبقاً ليستخدمها زر التحميل
+            probe_cache.prefetch(link.key, link.url)
+            
+            # الأزرار تحمل رمزاً قصيراً بدلاً من الرابط لأن حد بيانات الزر 64 بايت
+            token = callback_tokens.issue(link)
             keyboard = [
                 [
-                    InlineKeyboardButton("🎥 تحميل فيديو", callback_data=f"video_{url}"),
-                    InlineKeyboardButton("🎵 تحميل صوت", callback_data=f"audio_{url}")
+                    InlineKeyboardButton("🎥 تحميل فيديو", callback_data=f"video_{token}"),
+                    InlineKeyboardButton("🎵 تحميل صوت", callback_data=f"audio_{token}")
                 ]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -383,87 +2697,57 @@ def handle_button(update: Update, context: CallbackContext):
     
     try:
         if query.data.startswith('video_') or query.data.startswith('audio_'):
-            # استخراج الرابط ونوع التحميل
-            download_type, url = query.data.split('_', 1)
+            # استخراج رمز الرابط ونوع التحميل
+            download_type, token = query.data.split('_', 1)
             chat_id = query.message.chat_id
-            message_id = query.message.message_id
-            
-            # تحويل رابط Shorts إلى رابط فيديو عادي
-            if 'shorts' in url:
-                video_id = url.split('/')[-1].split('?')[0]
-                url = f'https://www.youtube.com/watch?v={video_id}'
             
-            # إنشاء رسالة التقدم الأولية مع شريط التقدم
-            initial_progress_text = (
-                f"📥 جاري التحميل...\n"
-                f"▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱ 0%\n"
-                f"⚡️ السرعة: -- MB/s\n"
-                f"⏳ الوقت المتبقي: -- ثانية\n"
-                f"📊 0/-- MB"
-            )
-            status_message = query.edit_message_text(initial_progress_text)
+            # الأزرار القديمة تحمل الرابط نفسه
+            link = callback_tokens.get(token) or parse_media_url(token)
+            if link is None:
+                query.edit_message_text("⌛️ انتهت صلاحية هذا الزر، الرجاء إرسال الرابط مرة أخرى.")
+                return
             
-            # إعداد خيارات التحميل
-            ydl_opts = {
-                'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best',
-                'outtmpl': f'downloads/{chat_id}/%(id)s.%(ext)s',
-                'progress_hooks': [lambda d: progress_callback(d, status_message)],
-                'merge_output_format': 'mp4',
-                'writethumbnail': True,
-                'restrictfilenames': True,
-                'windowsfilenames': True,
-            }
+            # البحث عن الملف في الذاكرة المؤقتة قبل التحميل
+            cache_key = MediaCache.make_key(link.platform, link.video_id, download_type, YOUTUBE_FORMATS[download_type])
+            cached = media_cache.get(cache_key)
+            if cached:
+                try:
+                    send_media(context.bot, chat_id, download_type, cached['file_id'], cached.get('caption', ''))
+                    update_user_stats(query.from_user.id, action='youtube')
+                    metrics.inc('bot_jobs_total', platform=link.platform, outcome='cached')
+                    query.edit_message_text("✅ تم التحميل بنجاح!")
+                    return
+                except BadRequest as e:
+                    logger.warning(f"معرف الملف المحفوظ غير صالح: {str(e)}")
+                    media_cache.invalidate(cache_key)
+                except TelegramError as e:
+                    # ضغط على الحد أو انقطاع مؤقت: المعرف ما يزال صالحاً، والتحميل قد يكرر ملفاً وصل بالفعل
+                    logger.warning(f"تعذر إرسال الملف المحفوظ: {str(e)}")
+                    query.answer("⚠️ تعذر إرسال الملف حالياً. الرجاء المحاولة بعد قليل.", show_alert=True)
+                    return
             
-            if download_type == 'audio':
-                ydl_opts.update({
-                    'format': 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }],
-                })
+            # فحص حدود الطلبات قبل التحميل مع إبقاء الأزرار لإعادة المحاولة
+            rejection = admission_message(query.from_user.id, chat_id)
+            if rejection:
+                query.answer(rejection, show_alert=True)
+                return
             
-            # إنشاء مجلد التحميل
-            download_path = f'downloads/{chat_id}'
-            os.makedirs(download_path, exist_ok=True)
+            # الاشتراك في تحميل جارٍ للفيديو نفسه بدلاً من تحميله مرة أخرى
+            status_message = query.edit_message_text("⏳ جاري تجهيز التحميل...")
+            flight_key = link.key + (download_type,)
+            if not in_flight.join(flight_key, status_message, query.from_user.id):
+                status_message.edit_text("⏳ هذا الفيديو قيد التحميل حالياً، سيصلك فور انتهائه...")
+                return
             
-            # تحميل الفيديو
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                if info is None:
-                    raise Exception("فشل في استخراج معلومات الفيديو")
-                
-                video_id = info.get('id', 'video')
-                ext = info.get('ext', 'mp4') if download_type == 'video' else 'mp3'
-                filename = os.path.join(download_path, f"{video_id}.{ext}")
-                
-                # إرسال الملف
-                with open(filename, 'rb') as file:
-                    caption = f"🎥 {info.get('title', 'Video')}" if download_type == 'video' else f"🎵 {info.get('title', 'Audio')}"
-                    
-                    if download_type == 'audio':
-                        context.bot.send_audio(
-                            chat_id=chat_id,
-                            audio=file,
-                            caption=caption
-                        )
-                    else:
-                        context.bot.send_video(
-                            chat_id=chat_id,
-                            video=file,
-                            caption=caption,
-                            supports_streaming=True
-                        )
-                
-                # تحديث إحصائيات المستخدم
-                update_user_stats(query.from_user.id, action='youtube')
-                
-                # حذف الملف بعد الإرسال
-                os.remove(filename)
-                
-                # تحديث رسالة النجاح
-                query.edit_message_text("✅ تم التحميل بنجاح!")
+            # إضافة التحميل إلى الطابور بدلاً من تنفيذه على خيط المعالجة
+            submitted = submit_download(
+                status_message, query.from_user.id, download_youtube_job,
+                context.bot, status_message, query.from_user.id, link, download_type
+            )
+            if not submitted:
+                deliver_to_followers(context.bot, in_flight.finish(flight_key, context.bot), download_type, {
+                    'error': "⚠️ البوت مشغول حالياً بعدد كبير من التحميلات. الرجاء المحاولة بعد قليل."
+                })
         
         else:
             handle_admin_buttons(update, context)
@@ -472,6 +2756,216 @@ def handle_button(update: Update, context: CallbackContext):
         logger.error(f"Error downloading YouTube: {str(e)}")
         query.edit_message_text("❌ عذراً، حدث خطأ أثناء التحميل. الرجاء المحاولة مرة أخرى.")
 
+def submit_download(status_message, user_id, func, *args):
+    """إضافة مهمة تحميل إلى الطابور وإبلاغ المستخدم بموقعه، ويرجع False عند الرفض"""
+    try:
+        position = download_scheduler.submit(user_id, func, *args)
+    except UserLimitError:
+        status_message.edit_text(
+            f"⚠️ لديك {MAX_JOBS_PER_USER} تحميلات قيد التنفيذ بالفعل.\n"
+            "الرجاء الانتظار حتى تنتهي ثم المحاولة مرة أخرى."
+        )
+        return False
+    except QueueFullError:
+        status_message.edit_text("⚠️ البوت مشغول حالياً بعدد كبير من التحميلات. الرجاء المحاولة بعد قليل.")
+        return False
+    
+    if position > 0:
+        try:
+            status_message.edit_text(f"⏳ طلبك في الطابور\n📍 موقعك: {position}")
+        except TelegramError:
+            pass
+    return True
+
+def download_youtube_job(bot, status_message, user_id, link, download_type):
+    """تحميل فيديو يوتيوب وإرساله (يعمل على عامل التحميل)"""
+    chat_id = status_message.chat_id
+    flight_key = link.key + (download_type,)
+    outcome = {'file_id': None, 'caption': '', 'error': "❌ عذراً، حدث خطأ أثناء التحميل. الرجاء المحاولة مرة أخرى."}
+    in_flight.attach(flight_key, status_message)
+    
+    try:
+        # إنشاء رسالة التقدم الأولية مع شريط التقدم
+        initial_progress_text = (
+            f"📥 جاري التحميل...\n"
+            f"▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱▱ 0%\n"
+            f"⚡️ السرعة: -- MB/s\n"
+            f"⏳ الوقت المتبقي: -- ثانية\n"
+            f"📊 0/-- MB"
+        )
+        status_message.edit_text(initial_progress_text)
+        
+        # إعداد خيارات التحميل
+        ydl_opts = {
+            'format': YOUTUBE_FORMATS[download_type],
+            'max_filesize': MAX_UPLOAD_BYTES,
+            'merge_output_format': 'mp4',
+            'writethumbnail': not STREAMING_PIPELINE,
+            'restrictfilenames': True,
+            'windowsfilenames': True,
+        }
+        
+        # في وضع الرفع المتدفق يرسل الصوت بصيغته الأصلية دون إعادة كتابة الملف
+        if download_type == 'audio' and not STREAMING_PIPELINE:
+            ydl_opts.update({
+                'postprocessors': [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'mp3',
+                    'preferredquality': '192',
+                }],
+            })
+        
+        # استخدام المعلومات المستخرجة مسبقاً واختيار صيغة ضمن حد الرفع قبل تحميل أي بيانات
+        probed = probe_cache.fetch(link.key, link.url)
+        estimated_size = None
+        if probed:
+            format_spec, estimated_size = plan_format(probed, download_type)
+            if format_spec is None and estimated_size is not None:
+                outcome['error'] = (
+                    f"❌ عذراً، حجم الملف ({round(estimated_size/1024/1024, 1)} MB) "
+                    f"يتجاوز الحد المسموح للرفع ({round(MAX_UPLOAD_BYTES/1024/1024)} MB)."
+                )
+                status_message.edit_text(outcome['error'])
+                return
+            if format_spec:
+                ydl_opts['format'] = format_spec
+        
+        # حجز مساحة للمهمة في مجلد مؤقت خاص بها يحذف بعد الانتهاء أو الفشل
+        reserve = (estimated_size or MAX_UPLOAD_BYTES) * 2  # الملف الأصلي وناتج الدمج أو التحويل
+        on_wait = lambda: status_message.edit_text("⏳ في انتظار توفر مساحة تخزين...")
+        with storage.job(reserve, on_wait=on_wait, name=job_journal.current()) as download_path:
+            # مجلد المهمة المسجلة ثابت، فيكمل yt-dlp ملفات .part بعد إعادة التشغيل
+            ydl_opts['outtmpl'] = os.path.join(download_path, '%(id)s.%(ext)s')
+            ydl_opts['continuedl'] = True
+            
+            # تحميل الفيديو (في هذه العملية أو في عمال العمليات المنفصلة)
+            info = run_ydl(link.url, ydl_opts, probed, in_flight.progress_hook(flight_key))
+            if info is None:
+                raise Exception("فشل في استخراج معلومات الفيديو")
+            
+            video_id = info.get('id', 'video')
+            ext = info.get('ext', 'mp4') if download_type == 'video' or STREAMING_PIPELINE else 'mp3'
+            filename = os.path.join(download_path, f"{video_id}.{ext}")
+            
+            # إرسال الملف
+            caption = f"🎥 {info.get('title', 'Video')}" if download_type == 'video' else f"🎵 {info.get('title', 'Audio')}"
+            job_journal.stage('uploading')
+            sent_message = upload_media(bot, chat_id, download_type, filename, caption)
+            
+            # حفظ معرف الملف لإعادة استخدامه دون تحميل أو رفع
+            file_id = get_sent_file_id(sent_message)
+            if file_id:
+                cache_key = MediaCache.make_key(link.platform, link.video_id, download_type, YOUTUBE_FORMATS[download_type])
+                media_cache.put(cache_key, file_id, caption)
+            outcome.update(file_id=file_id, caption=caption)
+            
+            # تحديث إحصائيات المستخدم
+            update_user_stats(user_id, action='youtube')
+            
+            # تحديث رسالة النجاح
+            metrics.inc('bot_jobs_total', platform=link.platform, outcome='downloaded')
+            status_message.edit_text("✅ تم التحميل بنجاح!")
+    
+    except DiskQuotaError:
+        metrics.inc('bot_jobs_total', platform=link.platform, outcome='no_space')
+        outcome['error'] = "⚠️ مساحة التخزين ممتلئة حالياً. الرجاء المحاولة بعد قليل."
+        status_message.edit_text(outcome['error'])
+    
+    except Exception as e:
+        logger.error(f"Error downloading YouTube: {str(e)}")
+        metrics.inc('bot_jobs_total', platform=link.platform, outcome='error')
+        status_message.edit_text(outcome['error'])
+    
+    finally:
+        # إرسال النتيجة نفسها لمن طلب الفيديو نفسه أثناء التحميل
+        deliver_to_followers(bot, in_flight.finish(flight_key, bot), download_type, outcome)
+
+def deliver_to_followers(bot, followers, download_type, outcome):
+    """إرسال نتيجة التحميل المشترك لباقي الطلبات المتطابقة"""
+    for message, follower_id in followers:
+        try:
+            if outcome.get('file_id'):
+                send_media(bot, message.chat_id, download_type, outcome['file_id'], outcome['caption'])
+                update_user_stats(follower_id, action='youtube')
+                metrics.inc('bot_jobs_total', platform='youtube', outcome='coalesced')
+                message.edit_text("✅ تم التحميل بنجاح!")
+            else:
+                message.edit_text(outcome['error'])
+        except TelegramError as e:
+            logger.error(f"خطأ في إرسال التحميل المشترك إلى {message.chat_id}: {str(e)}")
+
+def download_snapchat_job(status_message, user_id, url):
+    """تحميل فيديو سناب شات وإرساله (يعمل على عامل التحميل)"""
+    try:
+        on_wait = lambda: status_message.edit_text("⏳ في انتظار توفر مساحة تخزين...")
+        with storage.job(MAX_UPLOAD_BYTES, on_wait=on_wait, name=job_journal.current()) as temp_dir:
+            filename, title = download_snapchat(url, user_id, temp_dir)
+            if filename and os.path.exists(filename):
+                # إرسال الفيديو
+                job_journal.stage('uploading')
+                upload_media(status_message.bot, status_message.chat_id, 'video', filename, f"✅ تم التحميل بنجاح!\n🎥 {title}")
+                metrics.inc('bot_jobs_total', platform='snapchat', outcome='downloaded')
+                status_message.delete()
+            else:
+                metrics.inc('bot_jobs_total', platform='snapchat', outcome='error')
+                status_message.edit_text("❌ عذراً، فشل تحميل الفيديو. الرجاء المحاولة مرة أخرى.")
+    except DiskQuotaError:
+        metrics.inc('bot_jobs_total', platform='snapchat', outcome='no_space')
+        status_message.edit_text("⚠️ مساحة التخزين ممتلئة حالياً. الرجاء المحاولة بعد قليل.")
+    except Exception as e:
+        logger.error(f"Error downloading Snapchat video: {str(e)}")
+        metrics.inc('bot_jobs_total', platform='snapchat', outcome='error')
+        status_message.edit_text("❌ عذراً، حدث خطأ أثناء تحميل الفيديو. الرجاء المحاولة مرة أخرى.")
+
+# دوال المهام التي يمكن تنفيذها من الطابور المشترك
+JOB_FUNCTIONS = {func.__name__: func for func in (download_youtube_job, download_snapchat_job)}
+
+def resume_download_jobs(bot):
+    """استكمال مهام التحميل التي قطعها إيقاف البوت أو إنهاؤها برسالة واضحة، وحذف الملفات غير المكتملة"""
+    restart_failed = "❌ توقف التحميل بسبب إعادة تشغيل البوت. الرجاء إرسال الرابط مرة أخرى."
+    resumed = []
+    for job in job_journal.unfinished():
+        func = JOB_FUNCTIONS.get(job['kind'])
+        try:
+            args = [decode_job_arg(arg, bot) for arg in json.loads(job['payload'])]
+        except (ValueError, KeyError, TypeError):
+            args = None
+        
+        if func is None or args is None or job['attempts'] >= JOB_MAX_RESUMES:
+            text = restart_failed
+            job_journal.mark(job['id'], 'failed')
+        else:
+            text = "🔄 تمت إعادة تشغيل البوت، جاري استكمال التحميل..."
+            job_journal.mark(job['id'], 'queued', job['attempts'] + 1)
+            resumed.append((job, func, args))
+        
+        if job['status_message_id']:
+            try:
+                bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['status_message_id'])
+            except TelegramError as e:
+                logger.warning(f"تعذر تحديث رسالة المهمة {job['id']}: {str(e)}")
+    
+    # من كان ينتظر تحميلاً مشتركاً يستلم نتيجته عند استكماله، وإلا يبلغ بتوقفه
+    followers = job_journal.followers()
+    for job, func, args in resumed:
+        if func is download_youtube_job:
+            _, status_message, _, link, download_type = args
+            in_flight.restore(link.key + (download_type,), status_message, followers, bot)
+    for flight, members in followers.items():
+        for message, _ in members:
+            try:
+                bot.edit_message_text(restart_failed, chat_id=message['chat']['id'], message_id=message['message_id'])
+            except TelegramError as e:
+                logger.warning(f"تعذر تحديث رسالة طلب مشترك: {str(e)}")
+        job_journal.drop_followers(flight)
+    
+    # الأجزاء المحملة للمهام المستكملة تبقى، وما عداها لا يملكه أحد بعد إعادة التشغيل
+    storage.purge(keep={storage.dir_name(job['id']) for job, _, _ in resumed})
+    for job, func, args in resumed:
+        storage.hold(job['id'])
+        logger.info(f"استكمال مهمة التحميل {job['id']} ({job['state']}) للمستخدم {job['user_id']}")
+        download_scheduler.requeue(job['id'], job['user_id'], func, *args)
+
 def handle_admin_buttons(update: Update, context: CallbackContext):
     """معالجة أزرار لوحة تحكم المشرف"""
     query = update.callback_query
@@ -483,134 +2977,28 @@ def handle_admin_buttons(update: Update, context: CallbackContext):
     
     query.answer()
     
-    if query.data == 'list_users':
-        # تحديث حالة المستخدمين
-        current_time = datetime.now()
-        users_list = []
-        active_count = 0
-        inactive_count = 0
-        
-        for uid, user_data in users_data['users'].items():
-            # التعامل مع القيم الفارغة للتواريخ
-            last_active = user_data.get('last_active')
-            if not last_active or not isinstance(last_active, datetime):
-                last_active = current_time
-            
-            try:
-                days_inactive = (current_time - last_active).days
-            except (TypeError, AttributeError):
-                days_inactive = 0
-            
-            # تحديث حالة المستخدم
-            if days_inactive < 7:
-                status = 'نشط 🟢'
-                active_count += 1
-            else:
-                status = 'غير نشط 🔴'
-                inactive_count += 1
-            
-            # تحضير اسم المستخدم
-            user_name = user_data.get('first_name', '')
-            if user_data.get('last_name'):
-                user_name += f" {user_data.get('last_name')}"
-            user_name = user_name.strip() or "مستخدم مجهول"
-            
-            # تحضير المعرف
-            username = user_data.get('username', '')
-            username_display = f"@{username}" if username else "لا يوجد معرف"
-            
-            users_list.append({
-                'name': user_name,
-                'username': username_display,
-                'user_id': uid,
-                'status': status,
-                'downloads': {
-                    'total': user_data.get('downloads', 0),
-                    'youtube': user_data.get('youtube_downloads', 0),
-                    'snapchat': user_data.get('snapchat_downloads', 0)
-                },
-                'interactions': user_data.get('total_interactions', 0),
-                'last_active': last_active,
-                'join_date': user_data.get('join_date', current_time)
-            })
-        
-        # ترتيب المستخدمين حسب آخر نشاط
-        users_list.sort(key=lambda x: x['last_active'], reverse=True)
-        
-        # إنشاء رسالة الإحصائيات
-        stats_message = (
-            "👥 إحصائيات المستخدمين:\n"
-            "━━━━━━━━━━━━━━\n"
-            f"• المستخدمين النشطين: {active_count} 🟢\n"
-            f"• المستخدمين غير النشطين: {inactive_count} 🔴\n"
-            f"• الإجمالي: {len(users_list)}\n\n"
-            "قائمة جميع المستخدمين:\n"
-        )
-        
-        # إرسال رسالة الإحصائيات
-        query.edit_message_text(text=stats_message)
-        
-        # إنشاء قائمة المستخدمين
-        current_message = ""
-        for i, user in enumerate(users_list, 1):
-            try:
-                last_active_str = format_time_ago(user['last_active'])
-                join_date_str = user['join_date'].strftime('%d-%m-%Y')
-            except (TypeError, AttributeError):
-                last_active_str = "منذ لحظات"
-                join_date_str = datetime.now().strftime('%d-%m-%Y')
-            
-            user_info = (
-                f"{i}. {user['name']}\n"
-                f"↳ المعرف: {user['username']}\n"
-                f"↳ ID: {user['user_id']}\n"
-                f"↳ الحالة: {user['status']}\n"
-                f"↳ التحميلات:\n"
-                f"   • المجموع: {user['downloads']['total']}\n"
-                f"   • يوتيوب: {user['downloads']['youtube']}\n"
-                f"   • سناب شات: {user['downloads']['snapchat']}\n"
-                f"↳ التفاعلات: {user['interactions']}\n"
-                f"↳ آخر نشاط: {last_active_str}\n"
-                f"↳ تاريخ الانضمام: {join_date_str}\n\n"
-            )
-            
-            if len(current_message + user_info) > 4000:
-                context.bot.send_message(chat_id=query.message.chat_id, text=current_message)
-                current_message = user_info
-            else:
-                current_message += user_info
-        
-        if current_message:
-            keyboard = [[InlineKeyboardButton("🔄 رجوع", callback_data='back_to_menu')]]
-            context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=current_message,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+    if query.data == 'list_users' or query.data.startswith('users_'):
+        # عرض صفحة واحدة من قائمة المستخدمين حسب آخر نشاط
+        cursor, direction = None, 'next'
+        if query.data.startswith('users_'):
+            direction, timestamp, uid = query.data.split('_')[1:]
+            cursor = (int(float(timestamp)), int(uid))
+        refresh_users()
+        query.edit_message_text(**render_users_page(cursor, direction))
 
     elif query.data == 'general_stats':
+        refresh_users()
         total_downloads = users_data.get('total_downloads', 0)
-        youtube_downloads = sum(user.get('youtube_downloads', 0) for user in users_data['users'].values())
-        snapchat_downloads = sum(user.get('snapchat_downloads', 0) for user in users_data['users'].values())
-        
-        # حساب المستخدمين النشطين وغير النشطين
-        current_time = datetime.now()
-        active_users = 0
-        inactive_users = 0
-        
-        for user in users_data['users'].values():
-            last_active = user.get('last_active')
-            if not last_active or not isinstance(last_active, datetime):
-                last_active = current_time
-            
-            try:
-                days_inactive = (current_time - last_active).days
-                if days_inactive < 7:
-                    active_users += 1
-                else:
-                    inactive_users += 1
-            except (TypeError, AttributeError):
-                inactive_users += 1
+        youtube_downloads = user_totals.get('youtube_downloads')
+        snapchat_downloads = user_totals.get('snapchat_downloads')
+        
+        # حساب المستخدمين النشطين وغير النشطين من الفهارس دون المرور على جميع المستخدمين
+        active_users = user_index.active_count()
+        inactive_users = len(users_data['users']) - active_users
+        trend = " | ".join(f"{day}: {count}" for day, count in activity.daily_trend())
+        
+        cache_stats = media_cache.stats()
+        probe_stats = probe_cache.stats()
         
         message = (
             "📊 إحصائيات عامة\n"
@@ -618,38 +3006,110 @@ def handle_admin_buttons(update: Update, context: CallbackContext):
             f"👥 المستخدمين:\n"
             f"• نشط: {active_users} 🟢\n"
             f"• غير نشط: {inactive_users} 🔴\n"
-            f"• الإجمالي: {len(users_data['users'])}\n\n"
+            f"• الإجمالي: {len(users_data['users'])}\n"
+            f"• آخر ساعة: {activity.active_hours(1)}\n"
+            f"• DAU (آخر 24 ساعة): {activity.active_hours(24)}\n"
+            f"• WAU (آخر 7 أيام): {activity.active_days(7)}\n"
+            f"• النشاط اليومي: {trend}\n\n"
             f"📥 التحميلات:\n"
             f"• المجموع: {total_downloads}\n"
             f"• يوتيوب: {youtube_downloads}\n"
-            f"• سناب شات: {snapchat_downloads}\n"
+            f"• سناب شات: {snapchat_downloads}\n\n"
+            f"⚡️ الذاكرة المؤقتة:\n"
+            f"• الملفات المحفوظة: {cache_stats['size']}\n"
+            f"• نسبة الإصابة: {cache_stats['hit_rate']}% ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})\n"
+            f"• إصابة معلومات الفيديو: {probe_stats['hit_rate']}% ({probe_stats['hits']}/{probe_stats['hits'] + probe_stats['misses']})\n"
         )
         
         keyboard = [[InlineKeyboardButton("🔄 رجوع", callback_data='back_to_menu')]]
         query.edit_message_text(text=message, reply_markup=InlineKeyboardMarkup(keyboard))
 
+def format_user_entry(position, user_id, record, current_time):
+    """تنسيق بيانات مستخدم واحد في قائمة المستخدمين"""
+    last_active = record.last_active
+    status = 'نشط 🟢' if last_active and current_time - last_active < ACTIVE_DAYS * 86400 else 'غير نشط 🔴'
+    
+    # تحضير اسم المستخدم
+    user_name = record.first_name or ''
+    if record.last_name:
+        user_name += f" {record.last_name}"
+    user_name = user_name.strip() or "مستخدم مجهول"
+    
+    # تحضير المعرف
+    username = record.username
+    username_display = f"@{username}" if username else "لا يوجد معرف"
+    
+    join_date_str = datetime.fromtimestamp(record.join_date).strftime('%d-%m-%Y') if record.join_date else "غير متوفر"
+    last_active_str = format_time_ago(last_active) if last_active else "غير متوفر"
+    
+    return (
+        f"{position}. {user_name}\n"
+        f"↳ المعرف: {username_display}\n"
+        f"↳ ID: {user_id}\n"
+        f"↳ الحالة: {status}\n"
+        f"↳ التحميلات:\n"
+        f"   • المجموع: {record.downloads}\n"
+        f"   • يوتيوب: {record.youtube_downloads}\n"
+        f"   • سناب شات: {record.snapchat_downloads}\n"
+        f"↳ التفاعلات: {record.total_interactions}\n"
+        f"↳ آخر نشاط: {last_active_str}\n"
+        f"↳ تاريخ الانضمام: {join_date_str}\n\n"
+    )
+
+def render_users_page(cursor=None, direction='next'):
+    """بناء نص صفحة المستخدمين وأزرار التنقل من فهرس آخر نشاط"""
+    user_ids, first_key, last_key, has_newer, has_older, offset = user_index.page(cursor, direction)
+    total = len(users_data['users'])
+    active_count = user_index.active_count()
+    pages = max(1, -(-total // USERS_PAGE_SIZE))
+    
+    text = (
+        "👥 إحصائيات المستخدمين:\n"
+        "━━━━━━━━━━━━━━\n"
+        f"• المستخدمين النشطين: {active_count} 🟢\n"
+        f"• المستخدمين غير النشطين: {total - active_count} 🔴\n"
+        f"• الإجمالي: {total}\n\n"
+        f"📄 الصفحة {offset // USERS_PAGE_SIZE + 1} من {pages}\n\n"
+    )
+    current_time = time.time()
+    for i, uid in enumerate(user_ids, offset + 1):
+        record = users_data['users'].get(uid)
+        if record is not None:
+            text += format_user_entry(i, uid, record, current_time)
+    
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton("⬅️ السابق", callback_data=f'users_prev_{first_key[0]!r}_{first_key[1]}'))
+    if has_older:
+        navigation.append(InlineKeyboardButton("التالي ➡️", callback_data=f'users_next_{last_key[0]!r}_{last_key[1]}'))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🔄 رجوع", callback_data='back_to_menu')])
+    return {'text': text, 'reply_markup': InlineKeyboardMarkup(keyboard)}
+
 def get_back_button():
     """زر الرجوع للقائمة الرئيسية"""
     return InlineKeyboardMarkup([[InlineKeyboardButton("🔄 رجوع", callback_data='back_to_menu')]])
 
 def display_user_info(update: Update, context: CallbackContext, user_id):
     """عرض معلومات المستخدم"""
-    user_data = users_data['users'].get(str(user_id), {})
-    if user_data:
+    record = users_data['users'].get(int(user_id))
+    if record:
+        join_date = datetime.fromtimestamp(record.join_date).strftime('%d-%m-%Y') if record.join_date else 'غير متوفر'
+        last_active = format_time_ago(record.last_active) if record.last_active else 'غير متوفر'
         message = (
             f"📱 معلومات المستخدم\n"
             f"━━━━━━━━━━━━━━\n"
             f"🆔 المعرف: {user_id}\n"
-            f"👤 الاسم: {user_data.get('first_name', 'غير متوفر')}\n"
-            f"🌐 المعرف: @{user_data.get('username', 'غير متوفر')}\n"
-            f"📅 تاريخ الانضمام: {user_data.get('join_date').strftime('%d-%m-%Y')}\n"
-            f"⭐️ مستخدم مميز: {'نعم' if user_data.get('is_premium') else 'لا'}\n"
-            f"🗣 اللغة: {user_data.get('language_code', 'غير محدد')}\n"
-            f"⏱ آخر نشاط: {format_time_ago(user_data.get('last_active'))}\n"
+            f"👤 الاسم: {record.first_name or 'غير متوفر'}\n"
+            f"🌐 المعرف: @{record.username or 'غير متوفر'}\n"
+            f"📅 تاريخ الانضمام: {join_date}\n"
+            f"⭐️ مستخدم مميز: {'نعم' if record.is_premium else 'لا'}\n"
+            f"🗣 اللغة: {record.language_code or 'غير محدد'}\n"
+            f"⏱ آخر نشاط: {last_active}\n"
             f"📊 إحصائيات التحميل:\n"
-            f"   • إجمالي التحميلات: {user_data.get('downloads', 0)}\n"
-            f"   • تحميلات يوتيوب: {user_data.get('youtube_downloads', 0)}\n"
-            f"   • تحميلات سناب شات: {user_data.get('snapchat_downloads', 0)}\n"
+            f"   • إجمالي التحميلات: {record.downloads}\n"
+            f"   • تحميلات يوتيوب: {record.youtube_downloads}\n"
+            f"   • تحميلات سناب شات: {record.snapchat_downloads}\n"
         )
         if isinstance(update, Update):
             update.message.reply_text(message)
@@ -661,85 +3121,354 @@ def display_user_info(update: Update, context: CallbackContext, user_id):
         else:
             update.edit_message_text("❌ لم يتم العثور على معلومات المستخدم", reply_markup=get_back_button())
 
-def progress_callback(d, message):
-    if d['status'] == 'downloading':
-        try:
-            # التحقق من الوقت المنقضي منذ آخر تحديث
-            current_time = time.time()
-            if hasattr(progress_callback, 'last_update_time'):
-                # تحديث كل ثانية فقط
-                if current_time - progress_callback.last_update_time < 1:
-                    return
-            progress_callback.last_update_time = current_time
+def send_media(bot, chat_id, download_type, media, caption):
+    """إرسال ملف أو معرف ملف كصوت أو فيديو"""
+    if download_type == 'audio':
+        return bot.send_audio(
+            chat_id=chat_id,
+            audio=media,
+            caption=caption
+        )
+    return bot.send_video(
+        chat_id=chat_id,
+        video=media,
+        caption=caption,
+        supports_streaming=True
+    )
 
-            total = d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0)
-            downloaded = d.get('downloaded_bytes', 0)
-            
-            if total > 0:
-                # تقريب النسبة المئوية إلى رقمين عشريين
-                percentage = round((downloaded / total) * 100, 1)
-                
-                # إنشاء شريط التقدم
-                bar_length = 20
-                filled_length = int(bar_length * percentage / 100)
-                bar = '▰' * filled_length + '▱' * (bar_length - filled_length)
-                
-                # حساب وتقريب السرعة
-                speed = d.get('speed', 0)
-                if speed:
-                    speed = round(speed/1024/1024, 1)  # تقريب السرعة إلى رقم عشري واحد
-                    speed_str = f"{speed} MB/s"
-                else:
-                    speed_str = "-- MB/s"
-                
-                # حساب الوقت المتبقي
-                eta = d.get('eta', 0)
-                if eta:
-                    if eta > 60:
-                        minutes = eta // 60
-                        seconds = eta % 60
-                        eta_str = f"{minutes} دقيقة و {seconds} ثانية"
-                    else:
-                        eta_str = f"{eta} ثانية"
-                else:
-                    eta_str = "-- ثانية"
-                
-                # تقريب حجم الملف
-                total_mb = round(total/1024/1024, 1)
-                downloaded_mb = round(downloaded/1024/1024, 1)
-                
-                progress_text = (
-                    f"📥 جاري التحميل...\n"
-                    f"{bar} {percentage}%\n"
-                    f"⚡️ السرعة: {speed_str}\n"
-                    f"⏳ الوقت المتبقي: {eta_str}\n"
-                    f"📊 {downloaded_mb}/{total_mb} MB"
-                )
-                
-                # تحديث الرسالة فقط إذا تغير النص
-                if hasattr(progress_callback, 'last_message'):
-                    if progress_callback.last_message != progress_text:
-                        try:
-                            message.edit_text(progress_text)
-                            progress_callback.last_message = progress_text
-                        except Exception:
-                            pass  # تجاهل أخطاء تحديث الرسالة
-                else:
-                    try:
-                        message.edit_text(progress_text)
-                        progress_callback.last_message = progress_text
-                    except Exception:
-                        pass
-                    
+def upload_media(bot, chat_id, download_type, filename, caption):
+    """رفع ملف محلي بالطريقة المناسبة للوضع الحالي"""
+    with metrics.timer('upload'):
+        if STREAMING_PIPELINE:
+            message = stream_upload(bot, chat_id, download_type, filename, caption)
+        else:
+            with open(filename, 'rb') as file:
+                message = send_media(bot, chat_id, download_type, file, caption)
+    metrics.inc('bot_uploaded_bytes_total', os.path.getsize(filename))
+    return message
+
+class MultipartFileStream:
+    """جسم طلب multipart يقرأ الملف على أجزاء بدلاً من تحميله كاملاً في الذاكرة"""
+
+    def __init__(self, fields, file_field, path, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        head = b''
+        for name, value in fields.items():
+            head += (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode('utf-8')
+        head += (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{quote(os.path.basename(path))}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode('utf-8')
+        self.head = head
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.file = open(path, 'rb')
+        self.size = len(self.head) + os.path.getsize(path) + len(self.tail)
+        self.stage = 0  # 0 = الرأس، 1 = الملف، 2 = الذيل، 3 = انتهى
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        """قراءة جزء لا يتجاوز حجم الجزء المحدد"""
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        if self.stage == 0:
+            self.stage = 1
+            return self.head
+        if self.stage == 1:
+            data = self.file.read(size)
+            if data:
+                return data
+            self.stage = 2
+        if self.stage == 2:
+            self.stage = 3
+            return self.tail
+        return b''
+
+    def close(self):
+        self.file.close()
+
+def create_upload_session(pool_size):
+    """جلسة HTTP للرفع المتدفق تبقي الاتصالات مفتوحة بين الملفات"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+upload_session = create_upload_session(MEDIA_POOL_SIZE or DOWNLOAD_WORKERS + 1)
+
+def stream_upload(bot, chat_id, download_type, filename, caption):
+    """رفع الملف إلى Bot API على أجزاء وإرجاع رسالة تيليجرام"""
+    method, field = ('sendAudio', 'audio') if download_type == 'audio' else ('sendVideo', 'video')
+    fields = {'chat_id': chat_id, 'caption': caption}
+    if download_type != 'audio':
+        fields['supports_streaming'] = 'true'
+    
+    body = MultipartFileStream(fields, field, filename)
+    try:
+        response = upload_session.post(
+            f'{bot.base_url}/{method}',
+            data=body,
+            headers={'Content-Type': body.content_type},
+            timeout=(MEDIA_CONNECT_TIMEOUT, UPLOAD_TIMEOUT)
+        )
+    finally:
+        body.close()
+    
+    result = response.json()
+    if not result.get('ok'):
+        retry_after = (result.get('parameters') or {}).get('retry_after')
+        error = RetryAfter(retry_after) if retry_after else TelegramError(result.get('description', 'Upload failed'))
+        record_api_error(error)
+        raise error
+    return Message.de_json(result['result'], bot)
+
+def get_sent_file_id(message):
+    """استخراج معرف الملف من الرسالة المرسلة"""
+    if message is None:
+        return None
+    media = message.video or message.audio or message.document
+    return media.file_id if media else None
+
+def format_progress(d):
+    """إنشاء نص رسالة التقدم من بيانات yt-dlp"""
+    total = d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0)
+    downloaded = d.get('downloaded_bytes', 0)
+    if not total or total <= 0:
+        return None
+    
+    # تقريب النسبة المئوية إلى رقمين عشريين
+    percentage = round((downloaded / total) * 100, 1)
+    
+    # إنشاء شريط التقدم
+    bar_length = 20
+    filled_length = int(bar_length * percentage / 100)
+    bar = '▰' * filled_length + '▱' * (bar_length - filled_length)
+    
+    # حساب وتقريب السرعة
+    speed = d.get('speed', 0)
+    if speed:
+        speed = round(speed/1024/1024, 1)  # تقريب السرعة إلى رقم عشري واحد
+        speed_str = f"{speed} MB/s"
+    else:
+        speed_str = "-- MB/s"
+    
+    # حساب الوقت المتبقي
+    eta = d.get('eta', 0)
+    if eta:
+        if eta > 60:
+            minutes = eta // 60
+            seconds = eta % 60
+            eta_str = f"{minutes} دقيقة و {seconds} ثانية"
+        else:
+            eta_str = f"{eta} ثانية"
+    else:
+        eta_str = "-- ثانية"
+    
+    # تقريب حجم الملف
+    total_mb = round(total/1024/1024, 1)
+    downloaded_mb = round(downloaded/1024/1024, 1)
+    
+    return (
+        f"📥 جاري التحميل...\n"
+        f"{bar} {percentage}%\n"
+        f"⚡️ السرعة: {speed_str}\n"
+        f"⏳ الوقت المتبقي: {eta_str}\n"
+        f"📊 {downloaded_mb}/{total_mb} MB"
+    )
+
+class ProgressTracker:
+    """متابعة تقدم تحميل واحد برسالته وحالة التحديث الخاصة به"""
+
+    def __init__(self, message, limiter=None, interval=PROGRESS_UPDATE_INTERVAL):
+        self.message = message
+        self.limiter = limiter or edit_limiter
+        self.interval = interval
+        self.last_update_time = 0
+        self.last_text = None
+
+    def hook(self, d):
+        """دالة التقدم التي يستدعيها yt-dlp"""
+        if d['status'] != 'downloading':
+            return
+        try:
+            # التحقق من الوقت المنقضي منذ آخر تحديث لهذا التحميل
+            if time.monotonic() - self.last_update_time < self.interval:
+                return
+            progress_text = format_progress(d)
+            if progress_text:
+                self.update(progress_text)
         except Exception as e:
-            logging.error(f"Error in progress callback: {str(e)}")
+            logger.error(f"Error in progress callback: {str(e)}")
+
+    def update(self, text):
+        """تعديل الرسالة إذا تغير النص وسمح حد المعدل بذلك"""
+        if text == self.last_text:
+            return False
+        if not self.limiter.try_acquire(self.message.chat_id):
+            return False
+        self.last_update_time = time.monotonic()
+        if async_core.running:
+            self.last_text = text
+            async_core.edit_later(self.message, text)
+            return True
+        try:
+            self.message.edit_text(text)
+            self.last_text = text
+            return True
+        except RetryAfter as e:
+            self.limiter.penalize(self.message.chat_id, e.retry_after)
+        except TelegramError:
+            pass  # تجاهل أخطاء تحديث الرسالة
+        return False
+
+# حقول التقدم التي تنقل من عمليات التحميل إلى البوت
+PROGRESS_FIELDS = ('status', 'total_bytes', 'total_bytes_estimate', 'downloaded_bytes', 'speed', 'eta')
+
+def download_with_ydl(url, ydl_opts, probed, hook):
+    """تشغيل yt-dlp وإرجاع ملخص قابل للنقل بين العمليات"""
+    # أزمنة التحميل والمعالجة وحجم البيانات تحسب هنا لأن هذه الدالة قد تعمل في عملية منفصلة
+    started = time.monotonic()
+    marks = {'downloaded': started, 'bytes': 0}
+    
+    def progress(d):
+        if d.get('status') == 'finished':
+            marks['downloaded'] = time.monotonic()
+            marks['bytes'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+        if hook:
+            hook(d)
+    
+    opts = dict(ydl_opts, progress_hooks=[progress])
+    with load_yt_dlp().YoutubeDL(opts) as ydl:
+        if probed:
+            info = ydl.process_ie_result(probed, download=True)
+        else:
+            info = ydl.extract_info(url, download=True)
+        if info is None:
+            return None
+        finished = time.monotonic()
+        return {
+            'id': info.get('id'),
+            'title': info.get('title'),
+            'ext': info.get('ext'),
+            'extractor': info.get('extractor'),
+            'filepath': ydl.prepare_filename(info),
+            'downloaded_bytes': marks['bytes'],
+            'timings': {
+                'download': marks['downloaded'] - started,
+                'postprocess': finished - marks['downloaded'],
+            },
+        }
+
+# طابور التقدم داخل عملية التحميل المنفصلة
+_process_progress_queue = None
+
+def _init_download_process(progress_queue):
+    global _process_progress_queue
+    _process_progress_queue = progress_queue
+    load_yt_dlp()
+
+def _download_in_process(job_id, url, ydl_opts, probed):
+    """نقطة الدخول داخل عملية التحميل المنفصلة"""
+    def hook(d):
+        _process_progress_queue.put((job_id, {key: d.get(key) for key in PROGRESS_FIELDS}))
+    return download_with_ydl(url, ydl_opts, probed, hook)
+
+class DownloadProcessPool:
+    """تشغيل yt-dlp و ffmpeg في عمليات منفصلة لتوزيع التحويل على جميع الأنوية
+    
+    تعطل إحدى العمليات يفشل المهمة الحالية فقط ويعاد إنشاء المجمع دون إيقاف البوت.
+    """
+
+    def __init__(self, processes=0):
+        self.processes = processes
+        self.context = multiprocessing.get_context('spawn')
+        self.executor = None
+        self.progress_queue = None
+        self.hooks = {}  # معرف المهمة -> دالة التقدم
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.executor is not None
+
+    def start(self):
+        """إنشاء العمليات وخيط نقل التقدم"""
+        if self.processes <= 0:
+            return
+        self.progress_queue = self.context.Queue()
+        self.executor = self._create_executor()
+        threading.Thread(target=self._relay_progress, name='download-progress', daemon=True).start()
+
+    def _create_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=self.context,
+            initializer=_init_download_process,
+            initargs=(self.progress_queue,)
+        )
+
+    def run(self, url, ydl_opts, probed, hook):
+        """تنفيذ التحميل في عملية منفصلة وانتظار النتيجة"""
+        job_id = uuid.uuid4().hex
+        self.hooks[job_id] = hook
+        executor = self.executor
+        try:
+            return executor.submit(_download_in_process, job_id, url, ydl_opts, probed).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            logger.error("توقفت إحدى عمليات التحميل بشكل مفاجئ، جاري إعادة إنشاء المجمع")
+            with self.lock:
+                if self.executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self._create_executor()
+            raise
+        finally:
+            self.hooks.pop(job_id, None)
 
-def download_snapchat(url, user_id):
+    def _relay_progress(self):
+        while True:
+            job_id, d = self.progress_queue.get()
+            hook = self.hooks.get(job_id)
+            if hook:
+                hook(d)
+
+    def stop(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+download_processes = DownloadProcessPool(WORKER_PROCESSES)
+
+def run_ydl(url, ydl_opts, probed=None, hook=None):
+    """تشغيل yt-dlp في هذه العملية أو في عمال العمليات المنفصلة"""
+    try:
+        if download_processes.enabled:
+            info = download_processes.run(url, ydl_opts, probed, hook)
+        else:
+            info = download_with_ydl(url, ydl_opts, probed, hook)
+    except Exception:
+        metrics.inc('bot_stage_requests_total', stage='download', status='error')
+        raise
+    if info:
+        for stage, seconds in info['timings'].items():
+            metrics.observe('bot_stage_duration_seconds', seconds, stage=stage)
+            metrics.inc('bot_stage_requests_total', stage=stage, status='ok')
+        metrics.inc('bot_downloaded_bytes_total', info['downloaded_bytes'])
+    return info
+
+def download_snapchat(url, user_id, temp_dir):
     """تحميل فيديو من سناب شات"""
     try:
-        temp_dir = os.path.join(os.getcwd(), f'downloads_{user_id}')
-        os.makedirs(temp_dir, exist_ok=True)
-        
         ydl_opts = {
             'format': 'best',
             'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),
@@ -748,35 +3477,184 @@ def download_snapchat(url, user_id):
             'noplaylist': True
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'Snapchat video')
-            filename = ydl.prepare_filename(info)
-            
-            if not os.path.exists(filename):
-                possible_files = os.listdir(temp_dir)
-                for file in possible_files:
-                    if file.startswith(os.path.splitext(os.path.basename(filename))[0]):
-                        filename = os.path.join(temp_dir, file)
-                        break
-            
-            # تحديث إحصائيات المستخدم
-            update_user_stats(user_id, 'download')
-            update_user_stats(user_id, 'snapchat')
-            
-            return filename, title
+        info = run_ydl(url, ydl_opts)
+        title = info.get('title', 'Snapchat video')
+        filename = info['filepath']
+        
+        if not os.path.exists(filename):
+            possible_files = os.listdir(temp_dir)
+            for file in possible_files:
+                if file.startswith(os.path.splitext(os.path.basename(filename))[0]):
+                    filename = os.path.join(temp_dir, file)
+                    break
+        
+        # تحديث إحصائيات المستخدم
+        update_user_stats(user_id, 'download')
+        update_user_stats(user_id, 'snapchat')
+        
+        return filename, title
             
     except Exception as e:
         logger.error(f"Error downloading Snapchat video: {str(e)}")
         raise
 
+def estimate_format_size(fmt, duration):
+    """تقدير حجم الصيغة بالبايت من بيانات yt-dlp"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+def plan_format(info, download_type, budget=None):
+    """اختيار أفضل صيغة لا يتجاوز حجمها حد الرفع
+    
+    يرجع (الصيغة، الحجم المقدر)، أو (None، أصغر حجم) إذا لم تناسب أي صيغة،
+    أو (None، None) إذا لم تتوفر معلومات الحجم
+    """
+    budget = budget or MAX_UPLOAD_BYTES
+    duration = info.get('duration')
+    formats = info.get('formats') or []
+    sized = [(f, estimate_format_size(f, duration)) for f in formats]
+    audio_only = [(f, size) for f, size in sized
+                  if size and f.get('acodec') not in (None, 'none') and f.get('vcodec') == 'none']
+    
+    if download_type == 'audio':
+        if not audio_only:
+            return None, None
+        # عند التحويل إلى mp3 يعتمد حجم الملف النهائي على المدة فقط
+        if not STREAMING_PIPELINE and duration:
+            output_size = int(duration * MP3_BITRATE * 1000 / 8)
+            if output_size > budget:
+                return None, output_size
+            audio_only = [(f, output_size) for f, _ in audio_only]
+        candidates = [
+            (f['format_id'], size, (f.get('ext') == 'm4a', f.get('abr') or f.get('tbr') or 0))
+            for f, size in audio_only
+        ]
+    else:
+        progressive = [
+            (f['format_id'], size, (f.get('height') or 0, f.get('ext') == 'mp4', f.get('tbr') or 0))
+            for f, size in sized
+            if size and f.get('vcodec') not in (None, 'none') and f.get('acodec') not in (None, 'none')
+        ]
+        merged = []
+        video_only = [(f, size) for f, size in sized
+                      if size and f.get('vcodec') not in (None, 'none') and f.get('acodec') == 'none'
+                      and f.get('ext') == 'mp4']
+        m4a_audio = [(f, size) for f, size in audio_only if f.get('ext') == 'm4a']
+        for vf, vsize in video_only:
+            for af, asize in m4a_audio:
+                merged.append((
+                    f"{vf['format_id']}+{af['format_id']}", vsize + asize,
+                    (vf.get('height') or 0, True, (vf.get('tbr') or 0) + (af.get('tbr') or 0))
+                ))
+        # في وضع الرفع المتدفق تفضل الصيغ التي لا تحتاج دمجاً
+        if STREAMING_PIPELINE and any(size <= budget for _, size, _ in progressive):
+            candidates = progressive
+        else:
+            candidates = progressive + merged
+    
+    if not candidates:
+        return None, None
+    fitting = [c for c in candidates if c[1] <= budget]
+    if not fitting:
+        return None, min(size for _, size, _ in candidates)
+    format_id, size, _ = max(fitting, key=lambda c: c[2])
+    return format_id, size
+
+# أنماط الروابط المدعومة (مترجمة مرة واحدة)
+YOUTUBE_URL_PATTERN = re.compile(
+    r'(?:https?://)?(?:www\.|m\.|music\.)?'
+    r'(?:youtube\.com/(?:watch\?(?:\S*?&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)'
+    r'([0-9A-Za-z_-]{11})',
+    re.IGNORECASE
+)
+SNAPCHAT_URL_PATTERN = re.compile(
+    r'(?:https?://)?(?:[a-z]+\.)?snapchat\.com/([^\s?#]+)',
+    re.IGNORECASE
+)
+
+class MediaLink(namedtuple('MediaLink', ['platform', 'video_id', 'url'])):
+    """رابط فيديو بعد توحيده: (المنصة، معرف الفيديو، الرابط الموحد)"""
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """مفتاح ثابت للفيديو يستخدم في الذاكرة المؤقتة ومنع التكرار"""
+        return (self.platform, self.video_id)
+
+def parse_media_url(text):
+    """استخراج المنصة ومعرف الفيديو من الرابط أو None"""
+    match = YOUTUBE_URL_PATTERN.search(text)
+    if match:
+        video_id = match.group(1)
+        return MediaLink('youtube', video_id, f'https://www.youtube.com/watch?v={video_id}')
+    match = SNAPCHAT_URL_PATTERN.search(text)
+    if match:
+        path = match.group(1).rstrip('/')
+        return MediaLink('snapchat', path.split('/')[-1], match.group(0))
+    return None
+
 def is_youtube_url(url):
     """التحقق من رابط يوتيوب"""
-    return any(domain in url.lower() for domain in ['youtube.com', 'youtu.be'])
+    link = parse_media_url(url)
+    return link is not None and link.platform == 'youtube'
 
 def is_snapchat_url(url):
     """التحقق من رابط سناب شات"""
-    return 'snapchat.com' in url.lower()
+    link = parse_media_url(url)
+    return link is not None and link.platform == 'snapchat'
+
+# إعدادات رموز الأزرار
+CALLBACK_TOKENS_SIZE = int(os.getenv('CALLBACK_TOKENS_SIZE', '20000'))
+CALLBACK_TOKEN_TTL = int(os.getenv('CALLBACK_TOKEN_TTL', str(7 * 86400)))  # مدة صلاحية الرمز المحفوظ
+
+class CallbackTokenStore:
+    """ربط رموز قصيرة في بيانات الأزرار بالروابط المحفوظة في الخادم"""
+
+    def __init__(self, max_size=20000, shared=None, ttl=7 * 86400):
+        self.shared = shared  # حتى تعمل الأزرار بعد إعادة التشغيل ومهما كانت النسخة التي تستقبل الضغطة
+        self.ttl = ttl
+        self.max_size = max_size
+        self.links = OrderedDict()  # الرمز -> MediaLink
+        self.tokens = {}  # مفتاح الفيديو -> الرمز
+        self.saved = {}  # الرمز -> وقت آخر حفظ في الحالة
+        self.lock = threading.Lock()
+
+    def issue(self, link):
+        """إرجاع رمز الرابط مع إعادة استخدام الرمز نفسه للفيديو نفسه"""
+        with self.lock:
+            token = self.tokens.get(link.key)
+            if token is None:
+                token = secrets.token_urlsafe(8)
+                self.tokens[link.key] = token
+            self.links[token] = link
+            self.links.move_to_end(token)
+            while len(self.links) > self.max_size:
+                old_token, old_link = self.links.popitem(last=False)
+                self.tokens.pop(old_link.key, None)
+                self.saved.pop(old_token, None)
+            # الرمز المعاد استخدامه لا يكتب مرة أخرى إلا بعد مرور نصف مدة صلاحيته
+            now = time.time()
+            save = self.shared and now - self.saved.get(token, 0) > self.ttl / 2
+            if save:
+                self.saved[token] = now
+        if save:
+            self.shared.set(f'token:{token}', list(link), ttl=self.ttl)
+        return token
+
+    def get(self, token):
+        """إرجاع الرابط المرتبط بالرمز أو None"""
+        with self.lock:
+            link = self.links.get(token)
+        if link is None and self.shared:
+            value = self.shared.get(f'token:{token}')
+            link = MediaLink(*value) if value else None
+        return link
+
+callback_tokens = CallbackTokenStore(CALLBACK_TOKENS_SIZE, state, CALLBACK_TOKEN_TTL)
 
 def start(update: Update, context: CallbackContext):
     """تحديث إحصائيات المستخدم عند بدء استخدام البوت"""
@@ -815,17 +3693,11 @@ def search_user(update: Update, context: CallbackContext):
         update.message.reply_text("⚠️ الرجاء إدخال معرف المستخدم أو اسم المستخدم للبحث")
         return
     
-    search_term = context.args[0].lower()
-    found_users = []
-    
-    for user_id, user_data in users_data['users'].items():
-        if (str(user_id).lower() == search_term or 
-            str(user_data.get('username', '')).lower() == search_term.lstrip('@') or 
-            str(user_data.get('first_name', '')).lower().startswith(search_term)):
-            found_users.append((user_id, user_data))
+    refresh_users()
+    found_users = user_index.search(context.args[0])
     
     if found_users:
-        for user_id, _ in found_users:
+        for user_id in found_users:
             display_user_info(update, context, user_id)
     else:
         update.message.reply_text("❌ لم يتم العثور على المستخدم")
@@ -844,21 +3716,236 @@ def admin_dashboard(update: Update, context: CallbackContext):
     reply_markup = InlineKeyboardMarkup(keyboard)
     update.message.reply_text("🎛 لوحة تحكم المشرف\nاختر ما تريد عرضه:", reply_markup=reply_markup)
 
+# إعدادات استقبال التحديثات
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling أو webhook
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '4'))  # عدد خيوط معالجة التحديثات
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '0') == '1'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # الرابط العام الذي يرسل إليه تيليجرام
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """استقبال التحديثات من تيليجرام والتحقق من الرمز السري"""
+
+    def do_POST(self):
+        if self.path != self.server.webhook_path:
+            self.send_error(404)
+            return
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret, self.server.secret_token):
+            self.send_error(403)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_error(413 if length else 400)
+            return
+        try:
+            data = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        
+        self.server.on_update(data)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_error(405)
+
+    def log_message(self, format, *args):
+        logger.debug(f"webhook: {format % args}")
+
+def make_webhook_server(listen, port, path, secret_token, on_update):
+    """إنشاء خادم HTTP يمرر كل تحديث صالح إلى on_update"""
+    server = ThreadingHTTPServer((listen, port), WebhookHandler)
+    server.daemon_threads = True
+    server.webhook_path = path
+    server.secret_token = secret_token
+    server.on_update = on_update
+    return server
+
+def wait_for_stop_signal():
+    """الانتظار حتى وصول SIGINT أو SIGTERM"""
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+    while not stop_event.wait(1):
+        pass
+
+def run_webhook(updater):
+    """تشغيل البوت عبر webhook حتى وصول إشارة الإيقاف"""
+    if not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL مطلوب لتشغيل البوت في وضع webhook")
+    
+    bot = updater.bot
+    dispatcher = updater.dispatcher
+    
+    server = make_webhook_server(
+        WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+        lambda data: updater.update_queue.put(Update.de_json(data, bot))
+    )
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    
+    # التحديثات المعلقة تبقى عند تيليجرام حتى يستقبلها الخادم الجديد
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+        api_kwargs={'secret_token': WEBHOOK_SECRET}
+    )
+    logger.info(f"تم تشغيل البوت عبر webhook على المنفذ {WEBHOOK_PORT}!")
+    
+    wait_for_stop_signal()
+    logger.info("جاري إيقاف البوت...")
+    server.shutdown()
+    dispatcher.stop()
+    on_shutdown(None, None)
+
+# المقاييس التي تقرأ من حالة البوت عند كل طلب
+metrics.register('bot_download_queue_pending', 'gauge', 'Download jobs waiting for a worker',
+                 lambda: {(): download_scheduler.stats()['pending']})
+metrics.register('bot_download_workers_active', 'gauge', 'Download workers currently busy',
+                 lambda: {(): download_scheduler.stats()['active']})
+metrics.register('bot_download_workers', 'gauge', 'Configured download workers',
+                 lambda: {(): download_scheduler.workers})
+metrics.register('bot_downloads_in_flight', 'gauge', 'Distinct downloads in progress',
+                 lambda: {(): in_flight.count()})
+metrics.register('bot_scratch_reserved_bytes', 'gauge', 'Disk space reserved by running jobs',
+                 lambda: {(): storage.stats()['reserved']})
+
+def cache_requests():
+    values = {}
+    for name, cache in (('media', media_cache), ('probe', probe_cache)):
+        stats = cache.stats()
+        values[(('cache', name), ('result', 'hit'))] = stats['hits']
+        values[(('cache', name), ('result', 'miss'))] = stats['misses']
+    return values
+
+metrics.register('bot_cache_requests_total', 'counter', 'Cache lookups by cache and result', cache_requests)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """عرض المقاييس على /metrics"""
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(listen, port):
+    """تشغيل خادم المقاييس في الخلفية"""
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"المقاييس متاحة على http://{listen}:{server.server_port}/metrics")
+    return server
+
+def create_bot():
+    """إنشاء البوت بمجمعي اتصالات منفصلين للطلبات الصغيرة ورفع الملفات"""
+    # كل خيط يستدعي Bot API قد يحجز اتصالاً، والاتصالات الزائدة عن المجمع تغلق بعد كل طلب
+    api_pool_size = API_POOL_SIZE or (
+        BOT_WORKERS + DOWNLOAD_WORKERS + BROADCAST_WORKERS
+        + (ASYNC_API_CONCURRENCY if ASYNC_MODE else 0) + 4
+    )
+    media_request = MetricsRequest(
+        con_pool_size=MEDIA_POOL_SIZE or DOWNLOAD_WORKERS + 1,
+        connect_timeout=MEDIA_CONNECT_TIMEOUT,
+        read_timeout=UPLOAD_TIMEOUT
+    )
+    request = PooledRequest(
+        media_request, UPLOAD_TIMEOUT,
+        con_pool_size=api_pool_size,
+        connect_timeout=API_CONNECT_TIMEOUT,
+        read_timeout=API_READ_TIMEOUT
+    )
+    return Bot(TOKEN, request=request)
+
+def on_shutdown(signum, frame):
+    """حفظ التحديثات المعلقة عند إيقاف البوت"""
+    logger.info("جاري حفظ البيانات قبل الإيقاف...")
+    users_writer.flush()
+
 def main():
     """تشغيل البوت"""
+    if BOT_ROLE not in ('all', 'handler', 'worker'):
+        raise SystemExit(f"BOT_ROLE غير معروف: {BOT_ROLE}")
+    if BOT_ROLE != 'all' and not SHARED_STATE:
+        raise SystemExit("تقسيم العمل بين النسخ (BOT_ROLE) يتطلب SHARED_STATE=1")
+    if SHARED_STATE and BOT_MODE == 'webhook' and not os.getenv('WEBHOOK_SECRET'):
+        # كل نسخة تولد سراً مختلفاً وآخر من يسجل الـ webhook يجعل طلبات النسخ الأخرى مرفوضة
+        raise SystemExit("وضع webhook مع SHARED_STATE يتطلب WEBHOOK_SECRET مشتركاً بين جميع النسخ")
+    
     # تحميل بيانات المستخدمين عند بدء البوت
+    state.open()
     load_users_data()
+    media_cache.load()
+    users_writer.start()
     
-    updater = Updater(TOKEN)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+    
+    bot = create_bot()
+    if BOT_ROLE != 'handler':
+        download_processes.start()
+    if SHARED_STATE:
+        download_scheduler.start(bot)
+    else:
+        job_journal.open()
+        resume_download_jobs(bot)
+        download_scheduler.start()
+    # بعد الاستكمال حتى تكون مجلدات المهام المستكملة محجوزة قبل أول تنظيف
+    storage.start_janitor()
+    
+    # نسخة العمال تنفذ التحميلات من الطابور المشترك فقط دون استقبال التحديثات
+    if BOT_ROLE == 'worker':
+        logger.info(f"تم تشغيل عامل التحميل {INSTANCE_ID}!")
+        wait_for_stop_signal()
+        on_shutdown(None, None)
+        download_processes.stop()
+        return
+    
+    updater = Updater(bot=bot, workers=BOT_WORKERS, user_sig_handler=on_shutdown)
     dp = updater.dispatcher
 
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
-    dp.add_handler(CallbackQueryHandler(handle_button))  # معالج واحد لجميع الأزرار
+    # في وضع asyncio تعمل المعالجات كـ coroutines على حلقة واحدة
+    if ASYNC_MODE:
+        async_core.start()
+    wrap = async_core.handler if ASYNC_MODE else (lambda func: func)
+    
+    dp.add_handler(CommandHandler("start", wrap(start)))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, wrap(handle_message)))
+    dp.add_handler(CallbackQueryHandler(wrap(handle_button)))  # معالج واحد لجميع الأزرار
     
-    updater.start_polling(drop_pending_updates=True)
-    logger.info("تم تشغيل البوت!")
-    updater.idle()
+    # استكمال الرسائل الجماعية غير المكتملة ومتابعة ما تتوقف نسخته لاحقاً
+    broadcaster.resume(updater.bot)
+    broadcaster.start_watchdog(updater.bot)
+    
+    # استيراد yt-dlp في الخلفية بعد بدء الاستقبال حتى لا ينتظره أول تحميل
+    preload = threading.Thread(target=load_yt_dlp, name='yt-dlp-preload', daemon=True)
+    if BOT_MODE == 'webhook':
+        preload.start()
+        run_webhook(updater)
+    else:
+        updater.start_polling(drop_pending_updates=DROP_PENDING_UPDATES)
+        preload.start()
+        logger.info("تم تشغيل البوت!")
+        updater.idle()
+    users_writer.flush()
+    download_processes.stop()
 
 if __name__ == '__main__':
     main()